@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Offline benchmarks of extractors and url generation
+
+Every benchmark runs against synthetic pages in fixtures directory, no request is made. Pages are hand-written
+with the same scripts and markup the extractors look for, they are not captured from OLX.
+
+    py.test benchmarks.py --benchmark-autosave
+    py.test benchmarks.py --benchmark-compare --benchmark-compare-fail=mean:10%
+
+See tox benchmark environment.
+"""
+import sys
+
+import pytest
+from bs4 import BeautifulSoup
+
+import olx.category
+import olx.offer
+import olx.utils
+from conftest import read_fixture
+
+if sys.version_info < (3, 3):
+    from mock import mock
+else:
+    from unittest import mock
+
+GDANSK_URL = "https://www.olx.pl/nieruchomosci/mieszkania/wynajem/gdansk/"
+OFFER_URL = "https://www.olx.pl/oferta/gdansk-przymorze-dla-studentow-CID3-IDnT89A.html#1d9db51b24"
+
+FILTERS = {
+    "[filter_float_price:from]": 2000,
+    "[filter_float_price:to]": 3000,
+    "[filter_enum_floor_select][0]": 3,
+    "[filter_enum_furniture][0]": True,
+    "[filter_enum_builttype][0]": "blok",
+    "[filter_float_m:from]": 25,
+    "[filter_enum_rooms][0]": 2,
+}
+
+OFFER_EXTRACTORS = [
+    olx.offer.get_title,
+    olx.offer.parse_tracking_data,
+    olx.offer.get_additional_rent,
+    olx.offer.get_gps,
+    olx.offer.get_poster_name,
+    olx.offer.get_surface,
+    olx.offer.parse_description,
+    olx.offer.get_img_url,
+    olx.offer.get_date_added,
+    olx.offer.parse_region,
+    olx.offer.get_gpt_script,
+]
+
+CATEGORY_EXTRACTORS = [
+    olx.category.get_page_count,
+    olx.category.parse_ads_count,
+    olx.category.parse_search_page,
+    olx.category.parse_available_offers,
+]
+
+
+def get_markup(name, source):
+    markup = read_fixture(name)
+    return BeautifulSoup(markup, "html.parser") if source == "tree" else markup
+
+
+@pytest.mark.benchmark(group="offer extractors")
+@pytest.mark.parametrize("source", ["markup", "tree"])
+@pytest.mark.parametrize("extractor", OFFER_EXTRACTORS, ids=lambda extractor: extractor.__name__)
+def test_offer_extractor(benchmark, extractor, source):
+    markup = get_markup("offer.html", source)
+    assert benchmark(extractor, markup) is not None
+
+
+@pytest.mark.benchmark(group="offer extractors")
+def test_parse_flat_data(benchmark):
+    markup = get_markup("offer.html", "tree")
+    data_dict = olx.offer.get_gpt_script(markup)
+    assert benchmark(olx.offer.parse_flat_data, markup, data_dict)["rooms"] == 2
+
+
+@pytest.mark.benchmark(group="category extractors")
+@pytest.mark.parametrize("source", ["markup", "tree"])
+@pytest.mark.parametrize("extractor", CATEGORY_EXTRACTORS, ids=lambda extractor: extractor.__name__)
+def test_category_extractor(benchmark, extractor, source):
+    markup = get_markup("category.html", source)
+    assert benchmark(extractor, markup) is not None
+
+
+@pytest.mark.benchmark(group="category extractors")
+@pytest.mark.parametrize("extractor", [olx.category.parse_offer_url, olx.category.parse_ad_id],
+                         ids=lambda extractor: extractor.__name__)
+def test_offer_card_extractor(benchmark, extractor):
+    card = get_markup("category.html", "tree").find(class_="offer")
+    assert benchmark(extractor, card) is not None
+
+
+@pytest.mark.benchmark(group="parse")
+def test_parse_search_page(benchmark, parser_backend):
+    markup = read_fixture("category.html")
+    assert len(benchmark(olx.category.parse_search_page, markup)["offers"]) == 10
+
+
+@pytest.mark.benchmark(group="parse")
+def test_parse_offer_markup(benchmark, parser_backend):
+    markup = read_fixture("offer.html")
+    assert benchmark(olx.offer.parse_offer_markup, markup, OFFER_URL)["add_id"] == "393658437"
+
+
+@pytest.mark.benchmark(group="parse")
+def test_parse_offer(benchmark):
+    response = olx.utils.requests.Response()
+    response.status_code = 200
+    response._content = read_fixture("offer.html")
+    with mock.patch("olx.offer.get_content_for_url", return_value=response):
+        assert benchmark(olx.offer.parse_offer, OFFER_URL)["add_id"] == "393658437"
+
+
+@pytest.mark.benchmark(group="urls")
+def test_get_url(benchmark):
+    url = benchmark(olx.utils.get_url, "nieruchomosci", "mieszkania", "wynajem", "gdansk", None, 3, **FILTERS)
+    assert url.startswith(GDANSK_URL)
+
+
+@pytest.mark.benchmark(group="urls")
+def test_canonical_url(benchmark):
+    assert benchmark(olx.utils.canonical_url, OFFER_URL + "?utm_source=mail").endswith(".html")
+
+
+@pytest.mark.benchmark(group="urls")
+def test_city_name(benchmark):
+    assert benchmark(olx.utils.city_name, "Ruda Śląska") == "ruda-slaska"
@@ -0,0 +1,27 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Helpers shared by tests.py and benchmarks.py """
+import os
+
+import pytest
+
+import olx.utils
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), "rb") as fixture:
+        return fixture.read()
+
+
+@pytest.fixture(params=olx.utils.PARSER_BACKENDS)
+def parser_backend(request):
+    if request.param == "lxml":
+        pytest.importorskip("lxml")
+    elif request.param == "selectolax":
+        pytest.importorskip("selectolax")
+    default = olx.utils.PARSER_BACKEND
+    olx.utils.set_parser_backend(request.param)
+    yield request.param
+    olx.utils.set_parser_backend(default)
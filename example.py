@@ -5,7 +5,7 @@ import logging
 
 from olx import BASE_URL
 from olx.category import get_category
-from olx.offer import parse_offer
+from olx.offer import parse_offers
 
 log = logging.getLogger(__file__)
 
@@ -13,8 +13,8 @@ if __name__ == '__main__':
     search_filters = {
         "[filter_float_price:from]": 2000
     }
-    # parsed_urls = get_category(url="https://www.olx.pl/sopot/q-imac/",**search_filters)[:10]
-    parsed_urls = get_category("nieruchomosci", "mieszkania", "wynajem", "Gdańsk", **search_filters)[:3]
-    for element in (parse_offer(url) for url in parsed_urls if url and BASE_URL in url):
+    # parsed_urls = get_category(url="https://www.olx.pl/sopot/q-imac/", max_offers=10, **search_filters)
+    parsed_urls = get_category("nieruchomosci", "mieszkania", "wynajem", "Gdańsk", max_offers=3, **search_filters)
+    for url, element in parse_offers(url for url in parsed_urls if url and BASE_URL in url):
         print()
         print(element)
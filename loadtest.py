@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Local OLX stand-in server and crawler load test
+
+Server serves synthetic listing and offer pages with the same scripts and offer cards as OLX,
+with configurable latency, error rate and 429 throttling responses. Load test crawls category from it
+with :meth:'olx.category.get_category' and parses every offer with :meth:'olx.offer.parse_offers'.
+
+    python loadtest.py --pages 20 --workers 16 --latency 0.05 --throttle-rate 0.02
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import olx.utils
+from olx.cache import ResponseCache
+from olx.category import get_category
+from olx.offer import parse_offers
+
+if sys.version_info < (3, 0):
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+log = logging.getLogger(__file__)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+FIRST_AD_ID = 400000000
+
+LISTING_TEMPLATE = """<!DOCTYPE html>
+<html lang="pl">
+<head><meta charset="utf-8"/><title>Mieszkania na wynajem • OLX.pl</title><script>var pageName = 'listing';</script>\
+<script>var searchData = {{"category_id":"15","page_count":"{page_count}"}};</script></head>
+<body>
+<script>var GPT = GPT || {{}};GPT.slots = [];GPT.targeting = {{"cat_l0":"nieruchomosci","ads_count":"{ads_count}",\
+"page":"{page}"}};</script>
+<table id="offers_table" class="fixed offers breakword"><tbody>
+{cards}
+</tbody></table>
+</body>
+</html>
+"""
+
+CARD_TEMPLATE = """<tr class="wrap"><td class="offer{promoted}"><table summary="Ogłoszenie" \
+class="fixed offers breakword" data-id="{ad_id}"><tbody><tr><td class="title-cell"><h3><a href="{url}#{fragment}" \
+class="link linkWithHash detailsLink"><strong>Oferta {number}</strong></a></h3></td></tr></tbody></table></td></tr>"""
+
+
+def offer_url(base_url, number):
+    """ Returns url of synthetic offer
+
+    :param base_url: Server url
+    :param number: Offer number
+    :type base_url: str
+    :type number: int
+    :return: Offer url with offer id token
+    :rtype: str
+    """
+    return "{0}/oferta/oferta-{1}-CID3-IDL{1}.html".format(base_url, number)
+
+
+def render_listing(base_url, page, pages, offers_per_page, promoted=0):
+    """ Renders synthetic listing page
+
+    :param base_url: Server url
+    :param page: Page number, starting from 0
+    :param pages: Total page count
+    :param offers_per_page: Offers on one page
+    :param promoted: Number of promoted offers repeated on top of every page
+    :type base_url: str
+    :type page: int
+    :type pages: int
+    :type offers_per_page: int
+    :type promoted: int
+    :return: Listing page markup
+    :rtype: bytes
+    """
+    numbers = [(number, " promoted") for number in range(min(promoted, offers_per_page))]
+    first = page * offers_per_page
+    numbers += [(number, "") for number in range(first, first + offers_per_page)]
+    cards = "\n".join(CARD_TEMPLATE.format(promoted=kind, ad_id=FIRST_AD_ID + number, url=offer_url(base_url, number),
+                                           fragment="{0:010d}".format(index), number=number)
+                      for index, (number, kind) in enumerate(numbers))
+    return LISTING_TEMPLATE.format(page_count=pages, ads_count=pages * offers_per_page + promoted, page=page + 1,
+                                   cards=cards).encode("utf-8")
+
+
+def render_offer(number, template=None):
+    """ Renders synthetic offer page
+
+    Page is synthetic offer page from fixtures directory with ad id and title of given offer.
+
+    :param number: Offer number
+    :param template: Offer page markup used as template, defaults to fixtures/offer.html
+    :type number: int
+    :type template: bytes, None
+    :return: Offer page markup
+    :rtype: bytes
+    """
+    if template is None:
+        with open(os.path.join(FIXTURES_DIR, "offer.html"), "rb") as fixture:
+            template = fixture.read()
+    title = "Oferta {0}".format(number).encode("utf-8")
+    return template.replace(b"393658437", str(FIRST_AD_ID + number).encode("utf-8")).replace(
+        "Gdańsk Przymorze dla studentów".encode("utf-8"), title)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInServer(object):
+    """ Local HTTP server serving synthetic OLX pages
+
+    :Example:
+
+    >> with StandInServer(pages=5, latency=0.01) as server:
+    >>     get_category(url=server.category_url)
+    """
+
+    def __init__(self, pages=10, offers_per_page=20, promoted=2, latency=0.0, error_rate=0.0, throttle_rate=0.0,
+                 retry_after=1, seed=None):
+        """
+        :param pages: Total page count of category
+        :param offers_per_page: Offers on one listing page
+        :param promoted: Number of promoted offers repeated on top of every listing page
+        :param latency: Seconds every response is delayed by
+        :param error_rate: Fraction of requests answered with 500 Internal Server Error
+        :param throttle_rate: Fraction of requests answered with 429 Too Many Requests
+        :param retry_after: Retry-After header value of 429 responses
+        :param seed: Seed of error and throttling injection
+        :type pages: int
+        :type offers_per_page: int
+        :type promoted: int
+        :type latency: float
+        :type error_rate: float
+        :type throttle_rate: float
+        :type retry_after: int
+        :type seed: int, None
+        """
+        self.pages = pages
+        self.offers_per_page = offers_per_page
+        self.promoted = promoted
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.counters = {"listing": 0, "offer": 0, "errors": 0, "throttled": 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        with open(os.path.join(FIXTURES_DIR, "offer.html"), "rb") as fixture:
+            self._offer_template = fixture.read()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+    @property
+    def category_url(self):
+        return self.base_url + "/nieruchomosci/mieszkania/wynajem/"
+
+    def start(self):
+        """ Starts server on random free port in background thread
+
+        :return: Server url
+        :rtype: str
+        """
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def respond(self, path):
+        """ Builds response for requested path
+
+        :param path: Request path with query string
+        :type path: str
+        :return: Tuple of status code, headers and body
+        :rtype: tuple
+        """
+        with self._lock:
+            draw = self._random.random()
+            if draw < self.throttle_rate:
+                self.counters["throttled"] += 1
+                return 429, {"Retry-After": str(self.retry_after)}, b""
+            if draw < self.throttle_rate + self.error_rate:
+                self.counters["errors"] += 1
+                return 500, {}, b""
+        parts = urlparse(path)
+        match = olx.utils.OFFER_ID_PATTERN.search(parts.path)
+        if match is not None:
+            with self._lock:
+                self.counters["offer"] += 1
+            return 200, {}, render_offer(int(match.group(1)[1:]), self._offer_template)
+        page = int(parse_qs(parts.query).get("page", ["0"])[0])
+        with self._lock:
+            self.counters["listing"] += 1
+        return 200, {}, render_listing(self.base_url, page, self.pages, self.offers_per_page, self.promoted)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                status_code, headers, body = server.respond(self.path)
+                self.send_response(status_code)
+                headers = dict(headers, **{"Content-Type": "text/html; charset=utf-8",
+                                           "Content-Length": str(len(body))})
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def run_load_test(server, workers=None, rate=None, cache=False):
+    """ Crawls category from stand-in server and parses every offer
+
+    :param server: Started stand-in server
+    :param workers: Number of threads fetching offers and size of session pool, defaults to POOL_SIZE
+    :param rate: Requests per second allowed by rate limiter, rate limiting is disabled when not given
+    :param cache: Serve repeated requests from in-memory response cache
+    :type server: StandInServer
+    :type workers: int, None
+    :type rate: float, None
+    :type cache: bool
+    :return: Dictionary with counts, durations, pages/s, offers/s and server counters
+    :rtype: dict
+    """
+    workers = workers or olx.utils.POOL_SIZE
+    # Shared session, throttling, circuit breaking and cache are replaced for the test and restored afterwards
+    previous_session = olx.utils._session
+    previous_throttling = (olx.utils.THROTTLING, olx.utils._throttle_settings)
+    previous_circuit_breaking = (olx.utils.CIRCUIT_BREAKING, olx.utils._circuit_settings)
+    previous_cache = olx.utils.CACHE
+    olx.utils.set_session(pool_size=workers)
+    olx.utils.set_throttling(rate=rate, maximum=workers)
+    olx.utils.set_circuit_breaking()
+    olx.utils.set_cache(ResponseCache() if cache else None)
+    try:
+        start = time.time()
+        urls = get_category(url=server.category_url)
+        listing_time = time.time() - start
+        start = time.time()
+        offers = [offer for _, offer in parse_offers(urls, workers=workers) if offer is not None]
+        offer_time = time.time() - start
+    finally:
+        olx.utils.set_session(previous_session)
+        olx.utils.set_throttling(previous_throttling[0], **previous_throttling[1])
+        olx.utils.set_circuit_breaking(previous_circuit_breaking[0], **previous_circuit_breaking[1])
+        olx.utils.set_cache(previous_cache)
+    result = {
+        "pages": server.counters["listing"],
+        "offers": len(offers),
+        "listing_seconds": listing_time,
+        "offer_seconds": offer_time,
+        "pages_per_second": server.counters["listing"] / listing_time if listing_time else 0.0,
+        "offers_per_second": len(offers) / offer_time if offer_time else 0.0,
+    }
+    result.update(("server_" + name, value) for name, value in server.counters.items())
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--offers-per-page", type=int, default=20)
+    parser.add_argument("--promoted", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every response is delayed by")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 500 responses")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of 429 responses")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--rate", type=float, default=None, help="rate limit in requests per second")
+    parser.add_argument("--cache", action="store_true", help="enable in-memory response cache")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.ERROR)
+    with StandInServer(args.pages, args.offers_per_page, args.promoted, args.latency, args.error_rate,
+                       args.throttle_rate, args.retry_after, args.seed) as server:
+        result = run_load_test(server, args.workers, args.rate, args.cache)
+    for name, value in sorted(result.items()):
+        print("{0:<20} {1:.2f}".format(name, value) if isinstance(value, float) else "{0:<20} {1}".format(name, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from olx import category, offer
+from olx.category import drop_duplicates, get_page_url, parse_search_page
+from olx.utils import city_name, get_content_for_url, get_url, set_session
+
+log = logging.getLogger(__file__)
+
+CONCURRENCY = int(os.environ.get("OLX_CONCURRENCY", 20))
+
+_executor = None
+_executor_workers = 0
+
+
+def set_concurrency(concurrency):
+    """ Sets how many requests can be in flight at once
+
+    Blocking fetches and parsing run in a thread pool of this size, shared session pool is resized to match it.
+
+    :param concurrency: Maximal number of requests in flight
+    :type concurrency: int
+    """
+    global CONCURRENCY, _executor, _executor_workers
+    CONCURRENCY = concurrency
+    previous, _executor, _executor_workers = _executor, None, 0
+    if previous is not None:
+        previous.shutdown(wait=False)
+    set_session(pool_size=concurrency)
+
+
+def get_executor(workers=None):
+    """ Returns thread pool running blocking fetches and parsing
+
+    Pool is replaced with bigger one when more workers are requested, so concurrency above CONCURRENCY
+    isn't capped by it. Shared session pool is resized to match it, like in :meth:'olx.aio.set_concurrency'.
+
+    :param workers: Minimal number of workers, defaults to CONCURRENCY
+    :type workers: int, None
+    :return: Shared thread pool with at least CONCURRENCY workers
+    :rtype: concurrent.futures.ThreadPoolExecutor
+    """
+    global _executor, _executor_workers
+    workers = max(workers or CONCURRENCY, CONCURRENCY)
+    if _executor is None or _executor_workers < workers:
+        previous, _executor, _executor_workers = _executor, ThreadPoolExecutor(max_workers=workers), workers
+        if previous is not None:
+            previous.shutdown(wait=False)
+        if workers > CONCURRENCY:
+            set_session(pool_size=workers)
+    return _executor
+
+
+async def run(func, *args, semaphore=None):
+    """ Runs blocking function in thread pool
+
+    :param func: Function to call
+    :param args: Function arguments
+    :param semaphore: Semaphore bounding number of concurrent calls
+    :type semaphore: asyncio.Semaphore, None
+    :return: Result of func
+    """
+    loop = asyncio.get_event_loop()
+    if semaphore is None:
+        return await loop.run_in_executor(get_executor(), func, *args)
+    async with semaphore:
+        return await loop.run_in_executor(get_executor(), func, *args)
+
+
+def _fetch_search_page(url):
+    response = get_content_for_url(url)
+    if response is None:
+        return None
+    return parse_search_page(response.content)
+
+
+def _fetch_page_count(url):
+    return category.get_page_count_for_filters(url=url)
+
+
+async def get_page_count_for_filters(main_category=None, sub_category=None, detail_category=None, region=None,
+                                     search_query=None, url=None, semaphore=None, **filters):
+    """ Reads total page number for given search filters
+
+    Page is downloaded only until page count script is found.
+    See :meth:'olx.category.get_page_count_for_filters' for parameters reference.
+
+    :param semaphore: Semaphore bounding number of concurrent requests
+    :type semaphore: asyncio.Semaphore, None
+    :return: Total page number
+    :rtype: int
+    """
+    city = city_name(region) if region else None
+    if url is None:
+        url = get_url(main_category, sub_category, detail_category, city, search_query, **filters)
+    return await run(_fetch_page_count, url, semaphore=semaphore)
+
+
+async def get_offers_for_page(page, main_category=None, sub_category=None, detail_category=None, region=None,
+                              search_query=None, url=None, semaphore=None, **filters):
+    """ Parses offers for one specific page of given category with filters
+
+    See :meth:'olx.category.get_offers_for_page' for parameters reference.
+
+    :param semaphore: Semaphore bounding number of concurrent requests
+    :type semaphore: asyncio.Semaphore, None
+    :return: List of all offers for given page and parameters
+    :rtype: list
+    """
+    city = city_name(region) if region else None
+    page_url = get_page_url(page, main_category, sub_category, detail_category, city, search_query, url, **filters)
+    search_page = await run(_fetch_search_page, page_url, semaphore=semaphore)
+    log.info("Loaded page {0} of offers".format(page))
+    return search_page["offers"] if search_page else None
+
+
+async def get_category(main_category=None, sub_category=None, detail_category=None, region=None, search_query=None,
+                       url=None, concurrency=None, deduplicate=True, **filters):
+    """ Parses available offer urls from given category from every page
+
+    First page is loaded to read the page count, remaining pages are loaded concurrently.
+    See :meth:'olx.category.get_category' for parameters reference.
+
+    :param concurrency: Maximal number of pages loaded at once, defaults to CONCURRENCY
+    :param deduplicate: Skip offers repeated on previous pages, e.g. promoted ones
+    :type concurrency: int, None
+    :type deduplicate: bool
+    :return: List of all offers for given parameters
+    :rtype: list
+    """
+    semaphore = asyncio.Semaphore(concurrency or CONCURRENCY)
+    get_executor(concurrency)
+    city = city_name(region) if region else None
+    page_url = get_page_url(0, main_category, sub_category, detail_category, city, search_query, url, **filters)
+    first_page = await run(_fetch_search_page, page_url, semaphore=semaphore)
+    if first_page is None or first_page["offers"] is None:
+        return []
+    pages = await asyncio.gather(*[
+        get_offers_for_page(page, main_category, sub_category, detail_category, region, search_query, url,
+                            semaphore=semaphore, **filters)
+        for page in range(1, first_page["page_count"])
+    ])
+    parsed_content = list(first_page["offers"])
+    for offers in pages:
+        parsed_content.extend(offers or [])
+    if deduplicate:
+        unique, duplicates = drop_duplicates([(offer, None) for offer in parsed_content], set())
+        parsed_content = [offer for offer, _ in unique]
+        log.info("Dropped {0} duplicates".format(duplicates))
+    log.info("Loaded {0} offers".format(str(len(parsed_content))))
+    return parsed_content
+
+
+async def parse_offer(url, semaphore=None):
+    """ Parses data from offer page url
+
+    :param url: Url of current offer page
+    :param semaphore: Semaphore bounding number of concurrent requests
+    :type url: str
+    :type semaphore: asyncio.Semaphore, None
+    :return: Dictionary with all offer details or None if offer is not available anymore
+    :rtype: dict, None
+    """
+    return await run(offer.parse_offer, url, semaphore=semaphore)
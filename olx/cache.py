@@ -0,0 +1,720 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import re
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__file__)
+
+# Default time to live in seconds
+LISTING_TTL = 10 * 60
+OFFER_TTL = 24 * 60 * 60
+
+# Default stores use their own subdirectories of it, so they never remove each other's files
+CACHE_DIR = os.environ.get("OLX_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pyolx"))
+
+MEMORY_SIZE = 64 * 1024 * 1024
+DISK_SIZE = 1024 * 1024 * 1024
+
+# Rough memory taken by entry besides its content
+ENTRY_OVERHEAD = 1024
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Magic, codec, key length, payload length
+RECORD_HEADER = struct.Struct(">4sBHI")
+RECORD_MAGIC = b"OLXS"
+CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD, CODEC_DELETED = 0, 1, 2, 255
+CODECS = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}
+# Errors raised by decompressing and unpickling corrupted record
+DECODE_ERRORS = (zlib.error, pickle.UnpicklingError, EOFError, ValueError, TypeError) + \
+    ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# Response headers refreshed on revalidation
+VALIDATOR_HEADERS = ("ETag", "Last-Modified", "Cache-Control", "Expires", "Date")
+
+
+def cache_key(url):
+    """ Creates cache key for given url
+
+    :param url: Website url
+    :type url: str
+    :return: SHA-1 of url
+    :rtype: str
+    """
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+def is_offer_url(url):
+    """ Checks if url leads to offer page
+
+    :param url: Website url
+    :type url: str
+    :rtype: bool
+    """
+    return "/oferta/" in url
+
+
+def entry_from_response(response):
+    """ Creates cache entry from response
+
+    :param response: Response for requested url
+    :type response: requests.Response
+    :return: Cache entry
+    :rtype: dict
+    """
+    return {
+        "url": response.url,
+        "status_code": response.status_code,
+        "headers": dict(response.headers),
+        "encoding": response.encoding,
+        "content": response.content,
+        "stored_at": time.time(),
+    }
+
+
+def validation_headers(entry):
+    """ Creates conditional request headers from validators of cache entry
+
+    :param entry: Cache entry
+    :type entry: dict
+    :return: Dictionary with If-None-Match and If-Modified-Since headers, empty when response had no validators
+    :rtype: dict
+    """
+    headers = CaseInsensitiveDict(entry["headers"])
+    output = {}
+    if headers.get("ETag"):
+        output["If-None-Match"] = headers["ETag"]
+    if headers.get("Last-Modified"):
+        output["If-Modified-Since"] = headers["Last-Modified"]
+    return output
+
+
+def response_from_entry(entry):
+    """ Creates response from cache entry
+
+    Created response has from_cache attribute set to True and extracted attribute with data attached by
+    :meth:'olx.cache.ResponseCache.set_extracted' (None if there is no such data).
+
+    :param entry: Cache entry
+    :type entry: dict
+    :return: Response for cached url
+    :rtype: requests.Response
+    """
+    response = requests.Response()
+    response.url = entry["url"]
+    response.status_code = entry["status_code"]
+    response.headers = CaseInsensitiveDict(entry["headers"])
+    response.encoding = entry["encoding"]
+    response._content = entry["content"]
+    response.from_cache = True
+    response.extracted = entry.get("extracted")
+    return response
+
+
+def entry_size(entry):
+    return len(entry["content"]) + ENTRY_OVERHEAD
+
+
+class MemoryStore(object):
+    """ In-process LRU store limited by size of stored entries """
+
+    def __init__(self, max_size=MEMORY_SIZE):
+        """
+        :param max_size: Byte budget of stored entries
+        :type max_size: int
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        size = entry_size(entry)
+        if size > self.max_size:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= entry_size(previous)
+            self._entries[key] = entry
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= entry_size(evicted)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry_size(entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class DiskStore(object):
+    """ On-disk LRU store limited by size of stored files
+
+    Every entry is pickled into its own file. Files are written to temporary file and renamed, so the store
+    can be shared between threads and processes. Least recently read files are removed first.
+    """
+
+    def __init__(self, directory=None, max_size=DISK_SIZE):
+        """
+        :param directory: Store directory, defaults to "files" subdirectory of CACHE_DIR
+        :param max_size: Byte budget of stored files
+        :type directory: str, None
+        :type max_size: int
+        """
+        self.directory = directory or os.path.join(CACHE_DIR, "files")
+        self.max_size = max_size
+        self.evictions = 0
+        self._size = None
+        self._lock = threading.Lock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                entry = pickle.load(file)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return entry
+
+    def set(self, key, entry):
+        data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_size:
+            return
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(file_descriptor, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, self._path(key))
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            self.delete(name)
+        self._size = 0
+
+    def _files(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.startswith(".tmp-"):
+                continue
+            try:
+                stat = os.stat(self._path(name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+        return files
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._files())
+
+    def _evict(self):
+        # Files could be added or removed by other processes, size is recounted before eviction
+        files = sorted(self._files())
+        self._size = sum(size for _, size, _ in files)
+        for _, size, name in files:
+            if self._size <= self.max_size:
+                break
+            self.delete(name)
+            self._size -= size
+            self.evictions += 1
+
+
+def build_dictionary(samples, size=32 * 1024):
+    """ Builds shared compression dictionary from sample pages
+
+    With zstandard installed dictionary is trained from samples, otherwise it's made of the endings of samples,
+    which can be used as zlib preset dictionary.
+
+    :param samples: Sample page contents
+    :param size: Dictionary size in bytes, zlib uses at most 32 KB
+    :type samples: list
+    :type size: int
+    :return: Compression dictionary
+    :rtype: bytes
+    """
+    if zstandard is not None:
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    size = min(size, 32 * 1024)
+    chunk = max(size // max(len(samples), 1), 1)
+    return b"".join(sample[-chunk:] for sample in samples)[-size:]
+
+
+class SegmentStore(object):
+    """ On-disk store packing compressed entries into append-only segment files
+
+    Every entry is pickled, compressed with zstd (zlib if zstandard is not installed) and appended to the newest
+    segment as a record with its key. Index of records is built by scanning segments and records are read through mmap.
+    Appends are guarded by file lock, so one directory can be shared between threads and processes.
+    When segments exceed byte budget, the oldest segments are removed.
+    """
+
+    def __init__(self, directory=None, max_size=DISK_SIZE, segment_size=SEGMENT_SIZE, compression=None,
+                 dictionary=None, level=None):
+        """
+        :param directory: Store directory, defaults to "segments" subdirectory of CACHE_DIR
+        :param max_size: Byte budget of segment files
+        :param segment_size: Size after which new segment is started
+        :param compression: One of "zstd", "zlib" or "none", defaults to zstd when zstandard is installed
+        :param dictionary: Shared compression dictionary, see :meth:'olx.cache.build_dictionary'. It's saved in store
+        directory and used by every store opened on that directory.
+        :param level: Compression level
+        :type directory: str, None
+        :type max_size: int
+        :type segment_size: int
+        :type compression: str, None
+        :type dictionary: bytes, None
+        :type level: int, None
+
+        :except: ValueError when compression isn't available or dictionary differs from the saved one
+        """
+        self.directory = directory or os.path.join(CACHE_DIR, "segments")
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.compression = compression or ("zstd" if zstandard is not None else "zlib")
+        if self.compression not in CODECS or (self.compression == "zstd" and zstandard is None):
+            raise ValueError("Compression {0} is not available".format(self.compression))
+        self.level = level
+        self.evictions = 0
+        self._index = {}
+        self._scanned = {}
+        self._maps = {}
+        self._lock = threading.RLock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.dictionary = self._load_dictionary(dictionary)
+        self._refresh()
+
+    def _load_dictionary(self, dictionary):
+        path = os.path.join(self.directory, "dictionary")
+        with self._file_lock():
+            if os.path.exists(path):
+                with open(path, "rb") as file:
+                    saved = file.read()
+                if dictionary is not None and dictionary != saved:
+                    raise ValueError("Store in {0} uses different compression dictionary".format(self.directory))
+                return saved
+            if dictionary is not None:
+                with open(path, "wb") as file:
+                    file.write(dictionary)
+        return dictionary
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.directory, "segment-{0:06d}.dat".format(segment_id))
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            match = re.match(r"segment-(\d+)\.dat$", name)
+            if match:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def _map(self, segment_id, size):
+        mapped = self._maps.get(segment_id)
+        if mapped is None or len(mapped) < size:
+            if mapped is not None:
+                mapped.close()
+            with open(self._segment_path(segment_id), "rb") as file:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment_id] = mapped
+        return mapped
+
+    def _drop_segment(self, segment_id):
+        mapped = self._maps.pop(segment_id, None)
+        if mapped is not None:
+            mapped.close()
+        self._scanned.pop(segment_id, None)
+        dropped = [key for key, location in self._index.items() if location[0] == segment_id]
+        for key in dropped:
+            del self._index[key]
+        return len(dropped)
+
+    def _refresh(self):
+        """ Updates index with segments written and removed by other processes """
+        with self._lock:
+            segments = self._segments()
+            for segment_id in set(self._scanned) - set(segments):
+                self._drop_segment(segment_id)
+            for segment_id in segments:
+                self._scan(segment_id)
+
+    def _scan(self, segment_id):
+        try:
+            size = os.path.getsize(self._segment_path(segment_id))
+        except OSError:
+            return
+        position = self._scanned.get(segment_id, 0)
+        if size <= position:
+            return
+        mapped = self._map(segment_id, size)
+        while position + RECORD_HEADER.size <= size:
+            magic, codec, key_length, length = RECORD_HEADER.unpack_from(mapped, position)
+            if magic != RECORD_MAGIC:
+                log.warning("Segment {0} is corrupted at {1}".format(segment_id, position))
+                break
+            start = position + RECORD_HEADER.size
+            end = start + key_length + length
+            if end > size:
+                # Record is still being written
+                break
+            key = mapped[start:start + key_length].decode("utf-8")
+            if codec == CODEC_DELETED:
+                self._index.pop(key, None)
+            else:
+                self._index[key] = (segment_id, start + key_length, length, codec)
+            position = end
+        self._scanned[segment_id] = position
+
+    def _compress(self, data):
+        codec = CODECS[self.compression]
+        if codec == CODEC_ZSTD:
+            dict_data = zstandard.ZstdCompressionDict(self.dictionary) if self.dictionary else None
+            compressor = zstandard.ZstdCompressor(level=self.level or 3, dict_data=dict_data)
+            return codec, compressor.compress(data)
+        if codec == CODEC_ZLIB:
+            level = self.level if self.level is not None else 6
+            if self.dictionary:
+                compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY,
+                                              self.dictionary)
+            else:
+                compressor = zlib.compressobj(level)
+            return codec, compressor.compress(data) + compressor.flush()
+        return codec, data
+
+    def _decompress(self, codec, data):
+        if codec == CODEC_ZSTD:
+            dict_data = zstandard.ZstdCompressionDict(self.dictionary) if self.dictionary else None
+            return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+        if codec == CODEC_ZLIB:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS, self.dictionary) if self.dictionary \
+                else zlib.decompressobj()
+            return decompressor.decompress(data) + decompressor.flush()
+        return data
+
+    def _append(self, key, codec, payload):
+        key_bytes = key.encode("utf-8")
+        record = RECORD_HEADER.pack(RECORD_MAGIC, codec, len(key_bytes), len(payload)) + key_bytes + payload
+        with self._lock, self._file_lock():
+            self._refresh()
+            segments = self._segments()
+            segment_id = segments[-1] if segments else 1
+            used = self._scanned.get(segment_id, 0)
+            if used and used + len(record) > self.segment_size:
+                segment_id += 1
+            with open(self._segment_path(segment_id), "ab") as file:
+                file.write(record)
+            self._scan(segment_id)
+            self._evict()
+
+    def _evict(self):
+        segments = self._segments()
+        sizes = dict((segment_id, os.path.getsize(self._segment_path(segment_id))) for segment_id in segments)
+        total = sum(sizes.values())
+        for segment_id in segments[:-1]:
+            if total <= self.max_size:
+                break
+            self.evictions += self._drop_segment(segment_id)
+            os.remove(self._segment_path(segment_id))
+            total -= sizes[segment_id]
+
+    def get(self, key):
+        with self._lock:
+            if self._scanned:
+                # Picks up records appended to the newest segment by other processes
+                self._scan(max(self._scanned))
+            location = self._index.get(key)
+            if location is None:
+                self._refresh()
+                location = self._index.get(key)
+            if location is None:
+                return None
+            segment_id, offset, length, codec = location
+            try:
+                payload = self._map(segment_id, offset + length)[offset:offset + length]
+            except (IOError, OSError, ValueError):
+                self._drop_segment(segment_id)
+                return None
+        try:
+            return pickle.loads(self._decompress(codec, payload))
+        except DECODE_ERRORS as e:
+            log.warning("Dropping corrupted cache record {0}. Error: {1}".format(key, e))
+            self.delete(key)
+            return None
+
+    def set(self, key, entry):
+        codec, payload = self._compress(pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+        self._append(key, codec, payload)
+
+    def delete(self, key):
+        if self._index.get(key) is not None:
+            self._append(key, CODEC_DELETED, b"")
+
+    def clear(self):
+        with self._lock, self._file_lock():
+            for segment_id in self._segments():
+                self._drop_segment(segment_id)
+                os.remove(self._segment_path(segment_id))
+            self._index.clear()
+            self._scanned.clear()
+
+    @property
+    def size(self):
+        """ Total size of segment files in bytes """
+        return sum(os.path.getsize(self._segment_path(segment_id)) for segment_id in self._segments())
+
+    def __len__(self):
+        return len(self._index)
+
+
+class ResponseCache(object):
+    """ Two tier (memory and disk) cache of responses
+
+    Listing pages and offer pages have separate time to live. Entries are looked up in memory first,
+    entries found on disk are copied to memory.
+    """
+
+    def __init__(self, memory_size=MEMORY_SIZE, disk=None, listing_ttl=LISTING_TTL, offer_ttl=OFFER_TTL):
+        """
+        :param memory_size: Byte budget of memory tier, memory tier is disabled when it's 0
+        :param disk: Disk tier, see :class:'olx.cache.DiskStore' and :class:'olx.cache.SegmentStore'.
+        Disk tier is disabled when it's not given.
+        :param listing_ttl: Time to live of listing pages in seconds, None means entries never expire
+        :param offer_ttl: Time to live of offer pages in seconds, None means entries never expire
+        :type memory_size: int
+        :type disk: olx.cache.DiskStore, olx.cache.SegmentStore, None
+        :type listing_ttl: int, None
+        :type offer_ttl: int, None
+        """
+        self.memory = MemoryStore(memory_size) if memory_size else None
+        self.disk = disk
+        self.listing_ttl = listing_ttl
+        self.offer_ttl = offer_ttl
+        self._counters = {
+            "hits": 0, "misses": 0, "memory_hits": 0, "disk_hits": 0, "expired": 0, "revalidated": 0, "stores": 0,
+        }
+        self._lock = threading.Lock()
+
+    def _count(self, *names):
+        with self._lock:
+            for name in names:
+                self._counters[name] += 1
+
+    def ttl(self, url):
+        """ Returns time to live for given url
+
+        :param url: Website url
+        :type url: str
+        :return: Time to live in seconds or None if entry never expires
+        :rtype: int, None
+        """
+        return self.offer_ttl if is_offer_url(url) else self.listing_ttl
+
+    def is_fresh(self, url, entry):
+        ttl = self.ttl(url)
+        return ttl is None or time.time() - entry["stored_at"] < ttl
+
+    def lookup(self, url):
+        """ Searches for cache entry of given url in every tier
+
+        Expired entries are returned as well, so they can be revalidated.
+
+        :param url: Website url
+        :type url: str
+        :return: Tuple of cache entry (None if url isn't cached) and its freshness
+        :rtype: tuple
+        """
+        key = cache_key(url)
+        entry, tier = None, None
+        if self.memory is not None:
+            entry, tier = self.memory.get(key), "memory_hits"
+        if entry is None and self.disk is not None:
+            entry, tier = self.disk.get(key), "disk_hits"
+            if entry is not None and self.memory is not None:
+                self.memory.set(key, entry)
+        if entry is None:
+            self._count("misses")
+            return None, False
+        if not self.is_fresh(url, entry):
+            self._count("misses", "expired")
+            return entry, False
+        self._count("hits", tier)
+        return entry, True
+
+    def get(self, url):
+        """ Returns fresh cached response for given url
+
+        :param url: Website url
+        :type url: str
+        :return: Cached response or None if url isn't cached or entry expired
+        :rtype: requests.Response, None
+        """
+        entry, fresh = self.lookup(url)
+        return response_from_entry(entry) if fresh else None
+
+    def revalidate(self, url, entry, response):
+        """ Marks expired entry as fresh after server answered 304 Not Modified
+
+        :param url: Website url
+        :param entry: Expired cache entry
+        :param response: 304 response for conditional request
+        :type url: str
+        :type entry: dict
+        :type response: requests.Response
+        :return: Cached response with not_modified attribute set to True
+        :rtype: requests.Response
+        """
+        headers = dict(entry["headers"])
+        for name in VALIDATOR_HEADERS:
+            if name in response.headers:
+                headers[name] = response.headers[name]
+        entry = dict(entry, headers=headers, stored_at=time.time())
+        self.store(url, entry)
+        self._count("revalidated")
+        cached_response = response_from_entry(entry)
+        cached_response.not_modified = True
+        return cached_response
+
+    def set_extracted(self, url, data):
+        """ Attaches data extracted from cached page to its entry
+
+        Extracted data is served with cached response, see :meth:'olx.cache.response_from_entry', so unchanged page
+        doesn't have to be parsed again. Data is kept in memory tier only, so page isn't written to disk again.
+
+        :param url: Website url
+        :param data: Extracted data
+        :type url: str
+        :type data: dict
+        """
+        if self.memory is None:
+            return
+        key = cache_key(url)
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.set(key, dict(entry, extracted=data))
+
+    def set(self, url, response):
+        """ Stores response for given url
+
+        :param url: Website url
+        :param response: Response for requested url
+        :type url: str
+        :type response: requests.Response
+        """
+        self.store(url, entry_from_response(response))
+
+    def store(self, url, entry, count=True):
+        """ Stores cache entry for given url in every tier
+
+        Extracted data attached to entry is not written to disk tier.
+
+        :param url: Website url
+        :param entry: Cache entry
+        :param count: Count entry in stores statistic
+        :type url: str
+        :type entry: dict
+        :type count: bool
+        """
+        key = cache_key(url)
+        if self.memory is not None:
+            self.memory.set(key, entry)
+        if self.disk is not None:
+            if "extracted" in entry:
+                entry = dict(entry)
+                del entry["extracted"]
+            self.disk.set(key, entry)
+        if count:
+            self._count("stores")
+
+    def delete(self, url):
+        key = cache_key(url)
+        for tier in (self.memory, self.disk):
+            if tier is not None:
+                tier.delete(key)
+
+    def clear(self):
+        for tier in (self.memory, self.disk):
+            if tier is not None:
+                tier.clear()
+
+    def stats(self):
+        """ Returns hit and miss statistics
+
+        :return: Dictionary with hits, misses, hits per tier, number of expired, revalidated and stored entries,
+        evictions and hit rate
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = float(stats["hits"]) / lookups if lookups else 0.0
+        stats["evictions"] = sum(tier.evictions for tier in (self.memory, self.disk) if tier is not None)
+        stats["memory_size"] = self.memory.size if self.memory is not None else 0
+        return stats
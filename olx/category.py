@@ -4,27 +4,48 @@
 import json
 import logging
 import re
+import time
 
-from bs4 import BeautifulSoup
-
-from olx.utils import city_name, get_content_for_url, get_url
-from scrapper_helpers.utils import flatten
+from olx import metrics
+from olx.offer import parse_offers
+from olx.utils import (
+    canonical_url, city_name, find_script_data, get_content_for_url, get_fast_parser, get_html_parser, get_offer_id,
+    get_url
+)
 
 log = logging.getLogger(__file__)
-logging.basicConfig(level=logging.DEBUG)
 
 
 def get_page_count(markup):
     """ Reads total page number from OLX search page
 
+    Raw markup is searched with regular expression first, HTML tree is built only when that fails.
+
     :param markup: OLX search page markup
-    :type markup: str
+    :type markup: str, bytes, bs4.element.Tag
     :return: Total page number extracted from js script
     :rtype: int
     """
-    html_parser = BeautifulSoup(markup, "html.parser")
-    script = html_parser.head.script.next_sibling.next_sibling.next_sibling.text.split(",")
-    for element in script:
+    page_count = find_script_data(markup, "page_count")
+    if page_count is not None:
+        return page_count
+    html_parser = get_html_parser(markup)
+    try:
+        script = html_parser.head.script.next_sibling.next_sibling.next_sibling.text
+    except AttributeError:
+        script = ""
+    return read_page_count(script)
+
+
+def read_page_count(script):
+    """ Reads total page number from OLX search page script
+
+    :param script: Text of script with page_count
+    :type script: str
+    :return: Total page number
+    :rtype: int
+    """
+    for element in script.split(","):
         if "page_count" in element:
             current = element.split(":")
             out = ""
@@ -40,6 +61,8 @@ def get_page_count_for_filters(main_category=None, sub_category=None, detail_cat
                                search_query=None, url=None, **filters):
     """ Reads total page number for given search filters
 
+    Page is downloaded only until page count script is found.
+
     :param url: User defined url for OLX page with offers. It overrides category parameters and applies search filters.
     :param main_category: Main category
     :param sub_category: Sub category
@@ -59,30 +82,47 @@ def get_page_count_for_filters(main_category=None, sub_category=None, detail_cat
     city = city_name(region) if region else None
     if url is None:
         url = get_url(main_category, sub_category, detail_category, city, search_query, **filters)
-    response = get_content_for_url(url)
-    html_parser = BeautifulSoup(response.content, "html.parser")
-    script = html_parser.head.script.next_sibling.next_sibling.next_sibling.text.split(",")
-    for element in script:
-        if "page_count" in element:
-            current = element.split(":")
-            out = ""
-            for char in current[len(current) - 1]:
-                if char.isdigit():
-                    out += char
-            return int(out)
-    log.warning("Error no page number found. Please check if it's valid olx page.")
-    return 1
+    response = get_content_for_url(url, markers=("page_count",))
+    if response is None:
+        log.warning("Page count for {0} couldn't be loaded".format(url))
+        return 1
+    return get_page_count(response.content)
+
+
+def get_ads_count_for_filters(main_category=None, sub_category=None, detail_category=None, region=None,
+                              search_query=None, url=None, **filters):
+    """ Reads total number of ads for given search filters
+
+    Page is downloaded only until GPT targeting script is found.
+    See :meth:'olx.category.get_page_count_for_filters' for parameters reference.
+
+    :return: Total ads count
+    :rtype: int
+    """
+    city = city_name(region) if region else None
+    if url is None:
+        url = get_url(main_category, sub_category, detail_category, city, search_query, **filters)
+    response = get_content_for_url(url, markers=("GPT.targeting",))
+    if response is None:
+        log.warning("Ads count for {0} couldn't be loaded".format(url))
+        return 0
+    return parse_ads_count(response.content)
 
 
 def parse_ads_count(markup):
     """ Reads total number of adds
 
+    Raw markup is searched with regular expression first, HTML tree is built only when that fails.
+
     :param markup: OLX search page markup
-    :type markup: str
+    :type markup: str, bytes, bs4.element.Tag
     :return: Total ads count from script
     :rtype: int
     """
-    html_parser = BeautifulSoup(markup, "html.parser")
+    targeting = find_script_data(markup, "GPT.targeting")
+    if targeting is not None and "ads_count" in targeting:
+        return int(targeting["ads_count"])
+    html_parser = get_html_parser(markup)
     scripts = html_parser.find_all('script')
     for script in scripts:
         try:
@@ -91,8 +131,19 @@ def parse_ads_count(markup):
                 break
         except TypeError:
             continue
+    return read_ads_count(data)
+
+
+def read_ads_count(script):
+    """ Reads total number of adds from GPT targeting script
+
+    :param script: Text of script with GPT.targeting
+    :type script: str
+    :return: Total ads count
+    :rtype: int
+    """
     try:
-        data_dict = json.loads((re.split('GPT.targeting = |;', data))[3].replace(";", ""))
+        data_dict = json.loads((re.split('GPT.targeting = |;', script))[3].replace(";", ""))
     except json.JSONDecodeError as e:
         logging.info("JSON failed to parse GPT offer attributes. Error: {0}".format(e))
         return 0
@@ -105,39 +156,135 @@ def parse_offer_url(markup):
     Offer links on OLX are in class "linkWithHash".
     Only www.olx.pl domain is whitelisted.
 
-    :param markup: Search page markup
-    :type markup: str
+    :param markup: Offer card markup from search page
+    :type markup: str, bs4.element.Tag
     :return: Url with offer
     :rtype: str
     """
-    html_parser = BeautifulSoup(markup, "html.parser")
+    html_parser = get_html_parser(markup)
     url = html_parser.find("a").attrs['href']
     return url if url else None
 
 
-def parse_available_offers(markup):
-    """ Collects all offer links on search page markup
+def parse_ad_id(markup):
+    """ Searches for ad id in offer card markup
+
+    Ad id is the same as add_id parsed from offer page tracking data.
+
+    :param markup: Offer card markup from search page
+    :type markup: str, bs4.element.Tag
+    :return: Ad id or None if offer card has no id
+    :rtype: str, None
+    """
+    html_parser = get_html_parser(markup)
+    element = html_parser.find(attrs={"data-id": True})
+    return element.attrs["data-id"] if element is not None else None
+
+
+def parse_search_page(markup):
+    """ Reads offer links, ads count and page count from search page markup
+
+    Markup is parsed once and every value is read from that shared tree. Page count and ads count are read
+    from raw markup with regular expressions when possible.
+    With selectolax parser backend offer links and scripts are read straight from selectolax tree.
 
     :param markup: Search page markup
-    :type markup: str
-    :return: Links to offer on given search page
-    :rtype: list
+    :type markup: str, bytes, bs4.element.Tag
+    :return: Dictionary with links to offers on given search page (None if nothing was found), their ad ids,
+    ads count and page count
+    :rtype: dict
     """
-    html_parser = BeautifulSoup(markup, "html.parser")
+    with metrics.timer("olx_parse_seconds", page="search"):
+        return _parse_search_page(markup)
+
+
+def _parse_search_page(markup):
+    page_count = find_script_data(markup, "page_count")
+    targeting = find_script_data(markup, "GPT.targeting") or {}
+    ads_count = int(targeting["ads_count"]) if "ads_count" in targeting else None
+    fast_parser = get_fast_parser(markup)
+    if fast_parser is not None:
+        return _parse_search_page_fast(fast_parser, page_count, ads_count)
+    html_parser = get_html_parser(markup)
+    if page_count is None:
+        page_count = get_page_count(html_parser)
     not_found = html_parser.find(class_="emptynew")
     if not_found is not None:
         log.warning("No offers found")
-        return
-    ads_count = parse_ads_count(markup)
+        return {"offers": None, "ids": None, "ads_count": 0, "page_count": page_count}
+    if ads_count is None:
+        ads_count = parse_ads_count(html_parser)
     offers = html_parser.find_all(class_='offer')
     if len(offers) == 0:
         offers = html_parser.select("li.wrap.tleft")
-    parsed_offers = [parse_offer_url(str(offer)) for offer in offers if offer][:ads_count]
-    return parsed_offers
+    offers = offers[:ads_count]
+    return {
+        "offers": [parse_offer_url(offer) for offer in offers],
+        "ids": [parse_ad_id(offer) for offer in offers],
+        "ads_count": ads_count,
+        "page_count": page_count,
+    }
+
+
+def _parse_search_page_fast(fast_parser, page_count=None, ads_count=None):
+    """ selectolax version of :meth:'olx.category.parse_search_page', counts are read from tree when not given """
+    if page_count is None:
+        head_scripts = [script.text() for script in fast_parser.css("head script")]
+        page_count = read_page_count(next((script for script in head_scripts if "page_count" in script), ""))
+    if fast_parser.css_first(".emptynew") is not None:
+        log.warning("No offers found")
+        return {"offers": None, "ids": None, "ads_count": 0, "page_count": page_count}
+    if ads_count is None:
+        ads_count = read_ads_count(next(script.text() for script in fast_parser.css("script")
+                                        if "GPT.targeting" in script.text()))
+    offers = fast_parser.css(".offer")
+    if len(offers) == 0:
+        offers = fast_parser.css("li.wrap.tleft")
+    offers = offers[:ads_count]
+    ids = [offer.css_first("[data-id]") for offer in offers]
+    return {
+        "offers": [offer.css_first("a").attributes.get("href") or None for offer in offers],
+        "ids": [element.attributes.get("data-id") if element is not None else None for element in ids],
+        "ads_count": ads_count,
+        "page_count": page_count,
+    }
+
+
+def parse_available_offers(markup):
+    """ Collects all offer links on search page markup
+
+    :param markup: Search page markup
+    :type markup: str, bytes, bs4.element.Tag
+    :return: Links to offer on given search page
+    :rtype: list
+    """
+    return parse_search_page(markup)["offers"]
+
+
+def drop_duplicates(offers, seen):
+    """ Removes offers which were already seen in this crawl
+
+    Offers are compared by offer id read from their url, urls without id token are compared in canonical form.
+
+    :param offers: List of tuples of offer url and ad id
+    :param seen: Set of offer keys seen so far, keys of returned offers are added to it
+    :type offers: list
+    :type seen: set
+    :return: Tuple of unique offers and number of dropped duplicates
+    :rtype: tuple
+    """
+    unique = []
+    for offer in offers:
+        key = get_offer_id(offer[0]) or canonical_url(offer[0] or "")
+        if key in seen:
+            continue
+        seen.add(key)
+        unique.append(offer)
+    return unique, len(offers) - len(unique)
 
 
 def get_category(main_category=None, sub_category=None, detail_category=None, region=None, search_query=None, url=None,
-                 **filters):
+                 max_offers=None, max_pages=None, seen_ids=None, deduplicate=True, **filters):
     """ Parses available offer urls from given category from every page
 
     :param url: User defined url for OLX page with offers. It overrides category parameters and applies search filters.
@@ -146,6 +293,10 @@ def get_category(main_category=None, sub_category=None, detail_category=None, re
     :param detail_category: Detail category
     :param region: Region of search
     :param search_query: Additional search query
+    :param max_offers: Stop loading pages when this many offers were found
+    :param max_pages: Stop loading pages after this many pages
+    :param seen_ids: Store of already seen ad ids. See :meth:'olx.category.iter_category'
+    :param deduplicate: Skip offers repeated on previous pages, e.g. promoted ones
     :param filters: Dictionary with additional filters. Following example dictionary contains every possible filter
     with examples of it's values.
 
@@ -169,38 +320,179 @@ def get_category(main_category=None, sub_category=None, detail_category=None, re
     :type detail_category: str, None
     :type region: str, None
     :type search_query: str, None
+    :type max_offers: int, None
+    :type max_pages: int, None
+    :type seen_ids: set, None
+    :type deduplicate: bool
     :type filters: dict
     :return: List of all offers for given parameters
     :rtype: list
+
+    See :meth:'olx.category.iter_category' for generator version.
+    """
+    stats = {}
+    parsed_content = list(iter_category(main_category, sub_category, detail_category, region, search_query, url,
+                                        stats=stats, max_offers=max_offers, max_pages=max_pages, seen_ids=seen_ids,
+                                        deduplicate=deduplicate, **filters))
+    log.info("Loaded {0} offers, dropped {1} duplicates, {2:.2f} pages/s, {3:.2f} offers/s".format(
+        str(len(parsed_content)), stats.get("duplicates", 0), stats.get("pages_per_second", 0.0),
+        stats.get("offers_per_second", 0.0)))
+    return parsed_content
+
+
+def iter_category(main_category=None, sub_category=None, detail_category=None, region=None, search_query=None,
+                  url=None, parse=False, workers=None, stats=None, max_offers=None, max_pages=None, seen_ids=None,
+                  since=None, deduplicate=True, record=False, **filters):
+    """ Yields available offer urls from given category page by page
+
+    Only one search page is kept in memory at a time and first offers are yielded before next pages are loaded.
+    First search page is loaded once and used for both page count and its offers.
+
+    Incremental crawl: offers with ad id in seen_ids are skipped (and not parsed) and ids of yielded offers
+    are added to it. With parse enabled offers added before since are skipped as well.
+    Loading pages stops at first page without new offers.
+
+    Offers repeated across pages (promoted offers, urls differing only in fragment) are dropped before they are
+    parsed, their number is kept in stats under "duplicates".
+
+    :param url: User defined url for OLX page with offers. It overrides category parameters and applies search filters.
+    :param main_category: Main category
+    :param sub_category: Sub category
+    :param detail_category: Detail category
+    :param region: Region of search
+    :param search_query: Additional search query
+    :param parse: Yield parsed offer details instead of urls. Offers which are not available anymore are skipped.
+    :param workers: Number of threads parsing offers of one page. See :meth:'olx.offer.parse_offers'
+    :param stats: Dictionary filled with page_count and ads_count of the search, before first offer is yielded,
+    and with number of dropped duplicates, pages, offers, seconds, pages_per_second and offers_per_second
+    as pages are loaded
+    :param max_offers: Stop loading pages when this many offers were yielded
+    :param max_pages: Stop loading pages after this many pages
+    :param seen_ids: Store of already seen ad ids, any container supporting "in" and "add",
+    e.g. set or :class:'olx.storage.OfferStore'
+    :param since: Timestamp watermark, offers with older date_added are skipped. It's used only with parse enabled.
+    :param deduplicate: Skip offers repeated on previous pages
+    :param record: Yield compact Offer records instead of dictionaries, used only with parse enabled.
+    See :class:'olx.offer.Offer'
+    :param filters: See :meth category.get_category for reference
+    :type url: str, None
+    :type main_category: str, None
+    :type sub_category: str, None
+    :type detail_category: str, None
+    :type region: str, None
+    :type search_query: str, None
+    :type parse: bool
+    :type workers: int, None
+    :type stats: dict, None
+    :type max_offers: int, None
+    :type max_pages: int, None
+    :type seen_ids: set, olx.storage.OfferStore, None
+    :type since: int, None
+    :type deduplicate: bool
+    :type record: bool
+    :type filters: dict
+    :return: Generator of offer urls or offer details
+    :rtype: generator
     """
-    parsed_content, page, start_url = [], 0, None
+    started = time.time()
     city = city_name(region) if region else None
-    if url is None:
-        url = get_url(main_category, sub_category, detail_category, city, search_query, **filters)
-    else:
-        start_url = url
+    start_url = url
+    url = get_page_url(0, main_category, sub_category, detail_category, city, search_query, start_url, **filters)
+    log.debug(url)
     response = get_content_for_url(url)
-    page_max = get_page_count(response.content)
-    while page < page_max:
-        if start_url is None:
-            url = get_url(main_category, sub_category, detail_category, city, search_query, page, **filters)
+    if response is None:
+        log.warning("Search page {0} couldn't be loaded".format(url))
+        return
+    search_page = parse_search_page(response.content)
+    page, page_max, yielded = 0, search_page["page_count"], 0
+    if stats is None:
+        stats = {}
+    stats.update(page_count=page_max, ads_count=search_page["ads_count"], duplicates=0)
+    seen_offers = set() if deduplicate else None
+    if max_pages is not None:
+        page_max = min(page_max, max_pages)
+    while search_page["offers"] is not None:
+        log.info("Loaded page {0} of offers".format(page))
+        offers = list(zip(search_page["offers"], search_page["ids"]))
+        if seen_offers is not None:
+            offers, duplicates = drop_duplicates(offers, seen_offers)
+            stats["duplicates"] += duplicates
+        if seen_ids is not None:
+            offers = [(offer, ad_id) for offer, ad_id in offers if ad_id is None or ad_id not in seen_ids]
+        if max_offers is not None:
+            offers = offers[:max_offers - yielded]
+        new_offers = 0
+        if parse:
+            for _, offer in parse_offers([offer for offer, _ in offers], workers=workers, record=record):
+                if offer is None:
+                    continue
+                if seen_ids is not None:
+                    seen_ids.add(offer["add_id"])
+                if since is not None and offer["date_added"] < since:
+                    continue
+                new_offers += 1
+                yield offer
         else:
-            url = get_url(page=page, user_url=start_url, **filters)
+            for offer, ad_id in offers:
+                if seen_ids is not None and ad_id is not None:
+                    seen_ids.add(ad_id)
+                new_offers += 1
+                yield offer
+        yielded += new_offers
+        page += 1
+        _update_rates(stats, page, yielded, time.time() - started)
+        metrics.increment("olx_pages_total")
+        metrics.increment("olx_offers_total", new_offers)
+        if page >= page_max or (max_offers is not None and yielded >= max_offers):
+            break
+        if new_offers == 0 and (seen_ids is not None or since is not None):
+            log.info("No new offers on page {0}, stopping".format(page - 1))
+            break
+        url = get_page_url(page, main_category, sub_category, detail_category, city, search_query, start_url,
+                           **filters)
         log.debug(url)
         response = get_content_for_url(url)
-        log.info("Loaded page {0} of offers".format(page))
-        offers = parse_available_offers(response.content)
-        if offers is None:
+        if response is None:
+            log.warning("Search page {0} couldn't be loaded, stopping".format(url))
             break
-        parsed_content.append(offers)
-        page += 1
-    parsed_content = list(flatten(parsed_content))
-    log.info("Loaded {0} offers".format(str(len(parsed_content))))
-    return parsed_content
+        search_page = parse_search_page(response.content)
+
+
+def _update_rates(stats, pages, offers, seconds):
+    stats.update(pages=pages, offers=offers, seconds=seconds, pages_per_second=pages / seconds if seconds else 0.0,
+                 offers_per_second=offers / seconds if seconds else 0.0)
+
+
+def get_page_url(page, main_category=None, sub_category=None, detail_category=None, city=None, search_query=None,
+                 url=None, **filters):
+    """ Creates url of given search page
+
+    :param page: Page number
+    :param url: User defined url for OLX page with offers. It overrides category parameters and applies search filters.
+    :param main_category: Main category
+    :param sub_category: Sub category
+    :param detail_category: Detail category
+    :param city: City in OLX url format. See :meth:'olx.utils.city_name'
+    :param search_query: Additional search query
+    :param filters: See :meth category.get_category for reference
+    :type page: int
+    :type url: str, None
+    :type main_category: str, None
+    :type sub_category: str, None
+    :type detail_category: str, None
+    :type city: str, None
+    :type search_query: str, None
+    :type filters: dict
+    :return: Url of search page
+    :rtype: str
+    """
+    if url is None:
+        return get_url(main_category, sub_category, detail_category, city, search_query, page, **filters)
+    return get_url(page=page, user_url=url, **filters)
 
 
 def get_offers_for_page(page, main_category=None, sub_category=None, detail_category=None, region=None,
-                        search_query=None, url=None, **filters):
+                        search_query=None, url=None, max_offers=None, **filters):
     """ Parses offers for one specific page of given category with filters.
 
     :param page: Page number
@@ -209,6 +501,7 @@ def get_offers_for_page(page, main_category=None, sub_category=None, detail_cate
     :param sub_category: Sub category
     :param detail_category: Detail category
     :param region: Region of search
+    :param max_offers: Maximal number of returned offers
     :param filters: See :meth category.get_category for reference
     :type page: int
     :type url: str, None
@@ -217,17 +510,20 @@ def get_offers_for_page(page, main_category=None, sub_category=None, detail_cate
     :type detail_category: str, None
     :type region: str, None
     :type search_query: str, None
+    :type max_offers: int, None
     :type filters: dict
     :return: List of all offers for given page and parameters
     :rtype: list
     """
     city = city_name(region) if region else None
-    if url is None:
-        url = get_url(main_category, sub_category, detail_category, city, search_query, page=page, **filters)
-    else:
-        url = get_url(page=page, user_url=url, **filters)
+    url = get_page_url(page, main_category, sub_category, detail_category, city, search_query, url, **filters)
     response = get_content_for_url(url)
+    if response is None:
+        return
     log.info("Loaded page {0} of offers".format(page))
     offers = parse_available_offers(response.content)
+    if offers is None:
+        return
+    offers = offers[:max_offers]
     log.info("Loaded {0} offers".format(str(len(offers))))
     return offers
@@ -0,0 +1,307 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import csv
+import logging
+import os
+from abc import ABCMeta, abstractmethod
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+log = logging.getLogger(__file__)
+
+# Rows buffered before they are written as one row group (or CSV chunk)
+ROW_GROUP_SIZE = int(os.environ.get("OLX_ROW_GROUP_SIZE", 10000))
+
+# Columns of exported offers and their types
+SCHEMA = (
+    ("add_id", "string"),
+    ("title", "string"),
+    ("url", "string"),
+    ("price", "int64"),
+    ("currency", "string"),
+    ("city", "string"),
+    ("district", "string"),
+    ("voivodeship", "string"),
+    ("latitude", "float64"),
+    ("longitude", "float64"),
+    ("date_added", "timestamp"),
+    ("poster_name", "string"),
+    ("private_business", "string"),
+    ("surface", "float64"),
+    ("rooms", "int64"),
+    ("floor", "int64"),
+    ("built_type", "string"),
+    ("furniture", "bool"),
+    ("additional_rent", "int64"),
+    ("images", "list"),
+    ("description", "string"),
+)
+COLUMNS = tuple(name for name, _ in SCHEMA)
+
+FORMATS = ("csv", "parquet", "arrow")
+
+
+def _value(offer, column):
+    if column in ("latitude", "longitude"):
+        gps = offer["gps"] or (None, None)
+        value = gps[0] if column == "latitude" else gps[1]
+        return float(value) if value not in (None, "") else None
+    if isinstance(offer, dict):
+        return offer.get(column)
+    return offer[column]
+
+
+def offer_row(offer):
+    """ Reads exported values of one offer
+
+    :param offer: Offer details dictionary or record. See :meth:'olx.offer.parse_offer'
+    :type offer: dict, olx.offer.Offer
+    :return: Tuple of values in COLUMNS order
+    :rtype: tuple
+    """
+    return tuple(_value(offer, column) for column in COLUMNS)
+
+
+def offer_columns(offers):
+    """ Builds typed columns from parsed offers in one pass
+
+    :param offers: Offer details dictionaries or records. See :meth:'olx.offer.parse_offer'
+    :type offers: iterable
+    :return: Dictionary of column name and list of its values, see SCHEMA for columns and their types
+    :rtype: dict
+    """
+    columns = {column: [] for column in COLUMNS}
+    appends = [(column, columns[column].append) for column in COLUMNS]
+    for offer in offers:
+        for column, append in appends:
+            append(_value(offer, column))
+    return columns
+
+
+def get_arrow_schema():
+    """ Returns Arrow schema of exported offers
+
+    :return: Arrow schema built from SCHEMA
+    :rtype: pyarrow.Schema
+
+    :except: ImportError when pyarrow is not installed
+    """
+    if pyarrow is None:
+        raise ImportError("pyarrow is required for Arrow and Parquet export")
+    types = {
+        "string": pyarrow.string(),
+        "int64": pyarrow.int64(),
+        "float64": pyarrow.float64(),
+        "bool": pyarrow.bool_(),
+        "timestamp": pyarrow.timestamp("s"),
+        "list": pyarrow.list_(pyarrow.string()),
+    }
+    return pyarrow.schema([(name, types[kind]) for name, kind in SCHEMA])
+
+
+class BatchWriter(object, metaclass=ABCMeta):
+    """ Writes stream of parsed offers in fixed size row groups
+
+    Only one row group is kept in memory at a time. Subclasses implement writing of one row group.
+
+    :Example:
+
+    >> with BatchWriter.open("offers.parquet") as writer:
+    >>     writer.write_all(iter_category(url=url, parse=True))
+    """
+
+    def __init__(self, path, row_group_size=None):
+        """
+        :param path: Output file path
+        :param row_group_size: Rows written at once, defaults to ROW_GROUP_SIZE
+        :type path: str
+        :type row_group_size: int, None
+        """
+        self.path = path
+        self.row_group_size = row_group_size or ROW_GROUP_SIZE
+        self.rows = 0
+        self._buffer = []
+
+    @staticmethod
+    def open(path, format=None, row_group_size=None):
+        """ Creates writer for given format
+
+        :param path: Output file path
+        :param format: One of FORMATS, read from path extension when not given
+        :param row_group_size: Rows written at once, defaults to ROW_GROUP_SIZE
+        :type path: str
+        :type format: str, None
+        :type row_group_size: int, None
+        :return: Writer of given format
+        :rtype: BatchWriter
+
+        :except: ValueError when format is not supported
+        """
+        format = format or os.path.splitext(path)[1].lstrip(".").lower()
+        writers = {"csv": CSVWriter, "parquet": ParquetWriter, "arrow": ArrowWriter}
+        if format not in writers:
+            raise ValueError("Export format {0} is not supported. Use one of: {1}".format(format, ", ".join(FORMATS)))
+        return writers[format](path, row_group_size)
+
+    def write(self, offer):
+        """ Adds offer to current row group, row group is written when it's full
+
+        :param offer: Offer details dictionary or record, None is skipped
+        :type offer: dict, olx.offer.Offer, None
+        """
+        if offer is None:
+            return
+        self._buffer.append(offer)
+        if len(self._buffer) >= self.row_group_size:
+            self.flush()
+
+    def write_all(self, offers):
+        """ Writes every offer from iterable
+
+        :param offers: Offer details dictionaries or records
+        :type offers: iterable
+        :return: Number of rows written so far
+        :rtype: int
+        """
+        for offer in offers:
+            self.write(offer)
+        return self.rows
+
+    def flush(self):
+        """ Writes buffered offers as one row group """
+        if not self._buffer:
+            return
+        self._write_columns(offer_columns(self._buffer), len(self._buffer))
+        self.rows += len(self._buffer)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+    @abstractmethod
+    def _write_columns(self, columns, size):
+        """ Writes one row group
+
+        :param columns: Dictionary of column name and list of its values. See :meth:'olx.export.offer_columns'
+        :param size: Number of rows
+        :type columns: dict
+        :type size: int
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CSVWriter(BatchWriter):
+    """ Writes offers to CSV file with header, images are separated with spaces """
+
+    def __init__(self, path, row_group_size=None):
+        super(CSVWriter, self).__init__(path, row_group_size)
+        self._file = open(path, "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(COLUMNS)
+
+    def _write_columns(self, columns, size):
+        images = columns["images"]
+        columns["images"] = [" ".join(value) if value else None for value in images]
+        self._writer.writerows(zip(*(columns[column] for column in COLUMNS)))
+
+    def close(self):
+        super(CSVWriter, self).close()
+        self._file.close()
+
+
+class _ArrowBatchWriter(BatchWriter):
+
+    def __init__(self, path, row_group_size=None):
+        super(_ArrowBatchWriter, self).__init__(path, row_group_size)
+        self.schema = get_arrow_schema()
+        self._writer = self._create_writer()
+
+    @abstractmethod
+    def _create_writer(self):
+        """ Opens file writer with write_table and close methods """
+
+    def _write_columns(self, columns, size):
+        self._writer.write_table(pyarrow.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        super(_ArrowBatchWriter, self).close()
+        self._writer.close()
+
+
+class ParquetWriter(_ArrowBatchWriter):
+    """ Writes offers to Parquet file, every row group is written as Parquet row group """
+
+    def _create_writer(self):
+        return pyarrow.parquet.ParquetWriter(self.path, self.schema)
+
+
+class ArrowWriter(_ArrowBatchWriter):
+    """ Writes offers to Arrow IPC file, every row group is written as record batch """
+
+    def _create_writer(self):
+        return pyarrow.ipc.new_file(self.path, self.schema)
+
+
+def export(offers, path, format=None, row_group_size=None):
+    """ Writes stream of parsed offers to file
+
+    :Example:
+
+    >> export(iter_category(url=url, parse=True), "offers.parquet")
+
+    :param offers: Offer details dictionaries or records
+    :param path: Output file path
+    :param format: One of FORMATS, read from path extension when not given
+    :param row_group_size: Rows written at once, defaults to ROW_GROUP_SIZE
+    :type offers: iterable
+    :type path: str
+    :type format: str, None
+    :type row_group_size: int, None
+    :return: Number of written offers
+    :rtype: int
+    """
+    with BatchWriter.open(path, format, row_group_size) as writer:
+        writer.write_all(offers)
+    log.info("Exported {0} offers to {1}".format(writer.rows, path))
+    return writer.rows
+
+
+def to_dataframe(offers):
+    """ Builds pandas DataFrame from parsed offers
+
+    Columns are built in one pass and typed according to SCHEMA, integer columns are nullable.
+
+    :param offers: Offer details dictionaries or records
+    :type offers: iterable
+    :return: DataFrame with one row per offer
+    :rtype: pandas.DataFrame
+
+    :except: ImportError when pandas is not installed
+    """
+    if pandas is None:
+        raise ImportError("pandas is required to build DataFrame")
+    columns = offer_columns(offers)
+    types = {"string": "object", "int64": "Int64", "float64": "float64", "bool": "boolean", "list": "object"}
+    data = {}
+    for name, kind in SCHEMA:
+        if kind == "timestamp":
+            data[name] = pandas.to_datetime(pandas.Series(columns[name], dtype="float64"), unit="s")
+        else:
+            data[name] = pandas.Series(columns[name], dtype=types[kind])
+    return pandas.DataFrame(data, columns=list(COLUMNS))
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__file__)
+
+# Metrics are collected unless OLX_METRICS environmental variable is 0
+ENABLED = os.environ.get("OLX_METRICS", "1") != "0"
+
+# Upper bounds of histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    "olx_fetch_seconds": "Latency of requests made by get_content_for_url",
+    "olx_downloaded_bytes_total": "Bytes of response bodies downloaded",
+    "olx_fetch_errors_total": "Failed requests by error class",
+    "olx_cache_requests_total": "Response cache lookups by result",
+    "olx_parse_seconds": "Time of parsing whole page",
+    "olx_extract_seconds": "Time of single extractor in parse_offer_markup",
+    "olx_pages_total": "Search pages loaded by iter_category",
+    "olx_offers_total": "Offers yielded by iter_category",
+}
+
+
+class Collector(object):
+    """ Thread-safe in-memory store of counters, gauges and histograms
+
+    Every metric is identified by its name and labels.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        :param buckets: Upper bounds of histogram buckets
+        :type buckets: tuple
+        """
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value, labels):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, labels):
+        with self._lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def to_prometheus(self):
+        """ Renders metrics in Prometheus text exposition format
+
+        :return: Metrics text
+        :rtype: str
+        """
+        lines = []
+        with self._lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in metrics}):
+                    lines.extend(_header(name, kind))
+                    for (metric, labels), value in sorted(metrics.items()):
+                        if metric == name:
+                            lines.append("{0}{1} {2}".format(name, _labels(labels), value))
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.extend(_header(name, "histogram"))
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, histogram["buckets"]):
+                        cumulative += count
+                        lines.append("{0}_bucket{1} {2}".format(name, _labels(labels + (("le", repr(bound)),)),
+                                                                cumulative))
+                    lines.append("{0}_bucket{1} {2}".format(name, _labels(labels + (("le", "+Inf"),)),
+                                                            histogram["count"]))
+                    lines.append("{0}_sum{1} {2}".format(name, _labels(labels), histogram["sum"]))
+                    lines.append("{0}_count{1} {2}".format(name, _labels(labels), histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+
+def _header(name, kind):
+    if name in HELP:
+        yield "# HELP {0} {1}".format(name, HELP[name])
+    yield "# TYPE {0} {1}".format(name, kind)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + "}"
+
+
+COLLECTOR = Collector()
+_hooks = []
+
+
+def add_hook(hook):
+    """ Registers callback called with every recorded metric
+
+    :Example:
+
+    >> add_hook(lambda name, kind, value, labels: print(name, value))
+
+    :param hook: Callable taking metric name, kind ("counter", "gauge" or "histogram"), value and labels dictionary
+    :type hook: callable
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def _record(kind, name, value, labels):
+    if not ENABLED:
+        return
+    key = tuple(sorted(labels.items()))
+    if kind == "counter":
+        COLLECTOR.increment(name, value, key)
+    elif kind == "gauge":
+        COLLECTOR.set_gauge(name, value, key)
+    else:
+        COLLECTOR.observe(name, value, key)
+    for hook in _hooks:
+        try:
+            hook(name, kind, value, labels)
+        except Exception as e:
+            log.warning("Metrics hook {0} failed. Error: {1}".format(hook, e))
+
+
+def increment(name, value=1, **labels):
+    """ Increases counter
+
+    :param name: Metric name
+    :param value: Increase
+    :param labels: Metric labels
+    :type name: str
+    :type value: int, float
+    """
+    _record("counter", name, value, labels)
+
+
+def set_gauge(name, value, **labels):
+    """ Sets gauge to value
+
+    :param name: Metric name
+    :param value: Current value
+    :param labels: Metric labels
+    :type name: str
+    :type value: int, float
+    """
+    _record("gauge", name, value, labels)
+
+
+def observe(name, value, **labels):
+    """ Adds observation to histogram
+
+    :param name: Metric name
+    :param value: Observed value, durations are in seconds
+    :param labels: Metric labels
+    :type name: str
+    :type value: float
+    """
+    _record("histogram", name, value, labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    """ Observes duration of block in histogram
+
+    :Example:
+
+    >> with timer("olx_parse_seconds", page="offer"):
+    >>     parse_offer_markup(markup)
+
+    :param name: Metric name
+    :param labels: Metric labels
+    :type name: str
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def to_prometheus():
+    """ Renders collected metrics in Prometheus text exposition format
+
+    :return: Metrics text, e.g. body of scrape endpoint or content of node exporter textfile
+    :rtype: str
+    """
+    return COLLECTOR.to_prometheus()
+
+
+def reset():
+    """ Removes every collected metric """
+    COLLECTOR.reset()
+
+
+class StatsdHook(object):
+    """ Metrics hook sending every metric to statsd over UDP
+
+    Label values are appended to metric name, durations are sent as timers in milliseconds.
+
+    :Example:
+
+    >> add_hook(StatsdHook("localhost", 8125, prefix="crawler"))
+    """
+
+    def __init__(self, host="localhost", port=8125, prefix="olx"):
+        """
+        :param host: Statsd host
+        :param port: Statsd port
+        :param prefix: Prefix of every metric name
+        :type host: str
+        :type port: int
+        :type prefix: str, None
+        """
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, name, kind, value, labels):
+        """ Formats metric as statsd line
+
+        :return: Statsd line
+        :rtype: str
+        """
+        parts = ([self.prefix] if self.prefix else []) + [name] + [str(labels[key]) for key in sorted(labels)]
+        if kind == "counter":
+            return "{0}:{1}|c".format(".".join(parts), value)
+        if kind == "gauge":
+            return "{0}:{1}|g".format(".".join(parts), value)
+        if name.endswith("_seconds"):
+            return "{0}:{1:.3f}|ms".format(".".join(parts), value * 1000)
+        return "{0}:{1}|h".format(".".join(parts), value)
+
+    def __call__(self, name, kind, value, labels):
+        try:
+            self._socket.sendto(self.format(name, kind, value, labels).encode("utf-8"), self.address)
+        except socket.error as e:
+            log.debug("Sending metric to statsd failed. Error: {0}".format(e))
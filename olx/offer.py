@@ -4,47 +4,179 @@ import datetime as dt
 import json
 import logging
 import re
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import islice
 
-from bs4 import BeautifulSoup
-
-from olx.utils import get_content_for_url
+from olx import metrics
+from olx.utils import POOL_SIZE, Tag, find_script_data, get_content_for_url, get_html_parser, set_extracted
 
 try:
     from __builtin__ import unicode
 except ImportError:
     unicode = lambda x, *args: x
 
+if sys.version_info < (3, 0):
+    intern = lambda x: x
+else:
+    intern = sys.intern
+
 log = logging.getLogger(__file__)
 
+FLAT_FIELDS = ("floor", "rooms", "built_type", "furniture", "surface", "additional_rent")
+
+
+class Offer(object):
+    """ Compact offer details record
+
+    Attributes are kept in slots instead of per instance dictionary. Strings repeated across offers (city, district,
+    voivodeship, currency and similar) are interned, gps coordinates are floats and images are a tuple.
+    Fields can be read as attributes or by key, like dictionary returned by :meth:'olx.offer.parse_offer_markup'.
+
+    :Example:
+
+    >> offer = parse_offer(url, record=True)
+    >> offer.latitude, offer["city"]
+    (54.41, "Gdańsk")
+    """
+
+    __slots__ = ("title", "add_id", "price", "currency", "city", "district", "voivodeship", "latitude", "longitude",
+                 "description", "poster_name", "url", "date_added", "images", "private_business") + FLAT_FIELDS
+
+    def __init__(self, title=None, add_id=None, price=None, currency=None, city=None, district=None, voivodeship=None,
+                 gps=None, description=None, poster_name=None, url=None, date_added=None, images=None,
+                 private_business=None, floor=None, rooms=None, built_type=None, furniture=None, surface=None,
+                 additional_rent=None):
+        self.title = title
+        self.add_id = add_id
+        self.price = price
+        self.currency = _intern(currency)
+        self.city = _intern(city)
+        self.district = _intern(district)
+        self.voivodeship = _intern(voivodeship)
+        self.latitude, self.longitude = (_to_float(value) for value in (gps or (None, None)))
+        self.description = description
+        self.poster_name = poster_name
+        self.url = url
+        self.date_added = date_added
+        self.images = tuple(images) if images is not None else None
+        self.private_business = _intern(private_business)
+        self.floor = floor
+        self.rooms = rooms
+        self.built_type = _intern(built_type)
+        self.furniture = furniture
+        self.surface = surface
+        self.additional_rent = additional_rent
+
+    @property
+    def gps(self):
+        """ Tuple of latitude and longitude """
+        return self.latitude, self.longitude
+
+    def __getitem__(self, key):
+        if key != "gps" and key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        return isinstance(other, Offer) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Offer(add_id={0!r}, title={1!r})".format(self.add_id, self.title)
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def to_dict(self):
+        """ Converts record to offer details dictionary
+
+        Flat data fields are included only when any of them is set.
+
+        :return: Dictionary with all offer details
+        :rtype: dict
+        """
+        result = {
+            "title": self.title,
+            "add_id": self.add_id,
+            "price": self.price,
+            "currency": self.currency,
+            "city": self.city,
+            "district": self.district,
+            "voivodeship": self.voivodeship,
+            "gps": self.gps,
+            "description": self.description,
+            "poster_name": self.poster_name,
+            "url": self.url,
+            "date_added": self.date_added,
+            "images": list(self.images) if self.images is not None else None,
+            "private_business": self.private_business,
+        }
+        flat_data = {field: getattr(self, field) for field in FLAT_FIELDS}
+        if any(flat_data.values()):
+            result.update(flat_data)
+        return result
+
+
+def _intern(value):
+    return intern(value) if isinstance(value, str) else value
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
 
 def get_title(offer_markup):
     """ Searches for offer title on offer page
 
     :param offer_markup: Class "offerbody" from offer page markup
-    :type offer_markup: str
+    :type offer_markup: str, bs4.element.Tag
     :return: Title of offer
     :rtype: str, None
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    html_parser = get_html_parser(offer_markup)
     return html_parser.h1.text.strip()
 
 
 def parse_tracking_data(offer_markup):
     """ Parses price and add_id from OLX tracking data script
 
+    Raw markup is searched with regular expression first, HTML tree is built only when that fails.
+
     :param offer_markup: Head from offer page
-    :type offer_markup: str
+    :type offer_markup: str, bytes, bs4.element.Tag
     :return: Tuple of int price and it's currency or None if this offer page got deleted
     :rtype: tuple, None
 
     :except: This offer page got deleted and has no tracking script.
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
-    try:
-        script = html_parser.find('script').next_sibling.next_sibling.next_sibling.text
-    except AttributeError:
-        return None, None, None
-    data_dict = json.loads(re.split("pageView|;", script)[3].replace('":{', "{").replace("}}'", "}"))
+    data_dict = find_script_data(offer_markup, "pageView")
+    if data_dict is None or "ad_id" not in data_dict:
+        html_parser = get_html_parser(offer_markup)
+        try:
+            script = html_parser.find('script').next_sibling.next_sibling.next_sibling.text
+        except AttributeError:
+            return None, None, None
+        data_dict = json.loads(re.split("pageView|;", script)[3].replace('":{', "{").replace("}}'", "}"))
+    return read_tracking_data(data_dict)
+
+
+def read_tracking_data(data_dict):
+    """ Reads price and add_id from decoded tracking data
+
+    :param data_dict: Decoded pageView object of tracking data script
+    :type data_dict: dict
+    :return: Tuple of int price, it's currency and add_id
+    :rtype: tuple
+    """
     return int(data_dict.get("ad_price", 0)) or None, data_dict.get("price_currency"), data_dict["ad_id"]
 
 
@@ -52,11 +184,11 @@ def get_additional_rent(offer_markup):
     """ Searches for additional rental costs
 
     :param offer_markup:
-    :type offer_markup: str
+    :type offer_markup: str, bs4.element.Tag
     :return: Additional rent
     :rtype: int
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    html_parser = get_html_parser(offer_markup)
     table = html_parser.find_all(class_="item")
     for element in table:
         if "Czynsz" in element.text:
@@ -68,11 +200,11 @@ def get_gps(offer_markup):
     """ Searches for gps coordinates (latitude and longitude)
 
     :param offer_markup: Class "offerbody" from offer page markup
-    :type offer_markup: str
+    :type offer_markup: str, bs4.element.Tag
     :return: Tuple of gps coordinates
     :rtype: tuple
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    html_parser = get_html_parser(offer_markup)
     gps_lat = html_parser.find(class_="mapcontainer").attrs['data-lat']
     gps_lon = html_parser.find(class_="mapcontainer").attrs['data-lon']
     return gps_lat, gps_lon
@@ -82,13 +214,13 @@ def get_poster_name(offer_markup):
     """ Searches for poster name
 
     :param offer_markup: Class "offerbody" from offer page markup
-    :type offer_markup: str
+    :type offer_markup: str, bs4.element.Tag
     :return: Poster name or None if poster name was not found (offer is outdated)
     :rtype: str, None
 
     :except: Poster name not found
     """
-    poster_name_parser = BeautifulSoup(offer_markup, "html.parser").find(class_="offer-user__details")
+    poster_name_parser = get_html_parser(offer_markup).find(class_="offer-user__details")
     try:
         if poster_name_parser.a is not None:
             found_name = poster_name_parser.a.text.strip()
@@ -103,13 +235,13 @@ def get_surface(offer_markup):
     """ Searches for surface in offer markup
 
     :param offer_markup: Class "offerbody" from offer page markup
-    :type offer_markup: str
+    :type offer_markup: str, bs4.element.Tag
     :return: Surface or None if there is no surface
     :rtype: float, None
 
     :except: When there is no offer surface it will return None
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    html_parser = get_html_parser(offer_markup)
     try:
         surface = html_parser.sup.parent.text
     except AttributeError:
@@ -121,11 +253,11 @@ def parse_description(offer_markup):
     """ Searches for description if offer markup
 
     :param offer_markup: Body from offer page markup
-    :type offer_markup: str
+    :type offer_markup: str, bs4.element.Tag
     :return: Description of offer
     :rtype: str
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    html_parser = get_html_parser(offer_markup)
     return html_parser.find(id="textContent").text.replace("  ", "").replace("\n", " ").replace("\r", "").strip()
 
 
@@ -133,11 +265,11 @@ def get_img_url(offer_markup):
     """ Searches for images in offer markup
 
     :param offer_markup: Class "offerbody" from offer page markup
-    :type offer_markup: str
+    :type offer_markup: str, bs4.element.Tag
     :return: Images of offer in list
     :rtype: list
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    html_parser = get_html_parser(offer_markup)
     images = html_parser.find_all(class_="bigImage")
     output = []
     for img in images:
@@ -167,11 +299,11 @@ def get_date_added(offer_markup):
     """ Searches of date of adding offer
 
     :param offer_markup: Class "offerbody" from offer page markup
-    :type offer_markup: str
+    :type offer_markup: str, bs4.element.Tag
     :return: Date of adding offer
     :rtype: str
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    html_parser = get_html_parser(offer_markup)
     date = html_parser.find(class_="offer-titlebox__details").em.contents
     date = date[4] if len(date) > 4 else date[0]
     date = date.replace("Dodane", "").replace("\n", "").replace("  ", "").replace("o ", "").replace(", ", " ")
@@ -189,11 +321,11 @@ def parse_region(offer_markup):
     """ Parses region information
 
     :param offer_markup: Class "offerbody" from offer page markup
-    :type offer_markup: str
+    :type offer_markup: str, bs4.element.Tag
     :return: Region of offer
     :rtype: list
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    html_parser = get_html_parser(offer_markup)
     region = html_parser.find(class_="show-map-link").text
     return region.replace(", ", ",").split(",")
 
@@ -201,12 +333,17 @@ def parse_region(offer_markup):
 def get_gpt_script(offer_markup):
     """ Parses data from script of Google Tag Manager
 
+    Raw markup is searched with regular expression first, HTML tree is built only when that fails.
+
     :param offer_markup: Body from offer page markup
-    :type offer_markup: str
+    :type offer_markup: str, bytes, bs4.element.Tag
     :return: GPT dict data
     :rtype: dict
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    data_dict = find_script_data(offer_markup, "GPT.targeting")
+    if data_dict is not None:
+        return data_dict
+    html_parser = get_html_parser(offer_markup)
     scripts = html_parser.find_all('script')
     for script in scripts:
         if "GPT.targeting" in script.string:
@@ -227,7 +364,7 @@ def parse_flat_data(offer_markup, data_dict):
 
     :param offer_markup: Body from offer page markup
     :param data_dict: Dict with GPT script data
-    :type offer_markup: str
+    :type offer_markup: str, bs4.element.Tag
     :type data_dict: dict
     :return: Dictionary of flat data
     :rtype: dict
@@ -250,47 +387,160 @@ def parse_flat_data(offer_markup, data_dict):
     }
 
 
-def parse_offer(url):
-    """ Parses data from offer page url
+def parse_offer_markup(markup, url=None, record=False):
+    """ Parses data from offer page markup
+
+    Markup is parsed once and every field extractor runs against that shared tree.
+    Tracking data and GPT targeting scripts are read from raw markup with regular expressions when possible.
+    Parse time of page and of every extractor is recorded, see :mod:'olx.metrics'.
 
-    :param url: Offer page markup
+    :param markup: Offer page markup or already parsed tree
     :param url: Url of current offer page
-    :type url: str
-    :return: Dictionary with all offer details or None if offer is not available anymore
-    :rtype: dict, None
+    :param record: Return compact Offer record instead of dictionary. See :class:'olx.offer.Offer'
+    :type markup: str, bytes, bs4.element.Tag
+    :type url: str, None
+    :type record: bool
+    :return: Dictionary or record with all offer details or None if offer is not available anymore
+    :rtype: dict, Offer, None
     """
-    log.info(url)
-    html_parser = BeautifulSoup(get_content_for_url(url).content, "html.parser")
-    offer_content = str(html_parser.body)
-    poster_name = get_poster_name(offer_content)
-    price, currency, add_id = parse_tracking_data(str(html_parser.head))
+    with metrics.timer("olx_parse_seconds", page="offer"):
+        result = _parse_offer_markup(markup, url)
+    if result is None:
+        return None
+    return Offer(**result) if record else result
+
+
+def _extract(extractor, *args):
+    with metrics.timer("olx_extract_seconds", extractor=extractor.__name__):
+        return extractor(*args)
+
+
+def _parse_offer_markup(markup, url):
+    raw_markup = None if isinstance(markup, Tag) else markup
+    html_parser = _extract(get_html_parser, markup)
+    offer_content = html_parser.body or ""
+    poster_name = _extract(get_poster_name, offer_content)
+    tracking_data = _extract(find_script_data, raw_markup, "pageView")
+    if tracking_data is not None and "ad_id" in tracking_data:
+        price, currency, add_id = _extract(read_tracking_data, tracking_data)
+    else:
+        price, currency, add_id = _extract(parse_tracking_data, html_parser.head or "")
     if not all([add_id, poster_name]):
         log.info("Offer {0} is not available anymore.".format(url))
         return
-    region = parse_region(offer_content)
+    region = _extract(parse_region, offer_content)
     if len(region) == 3:
         city, voivodeship, district = region
     else:
         city, voivodeship = region
         district = None
-    data_dict = get_gpt_script(offer_content)
+    data_dict = _extract(find_script_data, raw_markup, "GPT.targeting")
+    if data_dict is None:
+        data_dict = _extract(get_gpt_script, offer_content)
     result = {
-        "title": get_title(offer_content),
+        "title": _extract(get_title, offer_content),
         "add_id": add_id,
         "price": price,
         "currency": currency,
         "city": city,
         "district": district,
         "voivodeship": voivodeship,
-        "gps": get_gps(offer_content),
-        "description": parse_description(offer_content),
+        "gps": _extract(get_gps, offer_content),
+        "description": _extract(parse_description, offer_content),
         "poster_name": poster_name,
         "url": url,
-        "date_added": get_date_added(offer_content),
-        "images": get_img_url(offer_content),
+        "date_added": _extract(get_date_added, offer_content),
+        "images": _extract(get_img_url, offer_content),
         "private_business": data_dict.get("private_business"),
     }
-    flat_data = parse_flat_data(offer_content, data_dict)
+    flat_data = _extract(parse_flat_data, offer_content, data_dict)
     if flat_data and any(flat_data.values()):
         result.update(flat_data)
     return result
+
+
+def parse_offer(url, record=False):
+    """ Parses data from offer page url
+
+    Data extracted from page is kept with its cached response, so unchanged pages served from cache
+    (including pages revalidated with 304 Not Modified) are not parsed again.
+
+    :param url: Url of current offer page
+    :param record: Return compact Offer record instead of dictionary. See :class:'olx.offer.Offer'
+    :type url: str
+    :type record: bool
+    :return: Dictionary or record with all offer details or None if offer is not available anymore
+    :rtype: dict, Offer, None
+    """
+    log.info(url)
+    return _fetch_and_parse_offer(url, record=record)
+
+
+def _fetch_and_parse_offer(url, process_pool=None, record=False):
+    response = get_content_for_url(url)
+    if response is None:
+        return None
+    # Cached page didn't change since its data was extracted
+    extracted = getattr(response, "extracted", None)
+    if extracted is not None:
+        return Offer(**extracted) if record else dict(extracted)
+    if process_pool is None:
+        result = parse_offer_markup(response.content, url)
+    else:
+        result = process_pool.submit(parse_offer_markup, response.content, url).result()
+    if result is None:
+        return None
+    set_extracted(url, result)
+    return Offer(**result) if record else dict(result)
+
+
+def parse_offers(urls, workers=None, processes=None, record=False):
+    """ Parses data from many offer page urls concurrently
+
+    Pages are fetched in a thread pool. When processes are given, markup is parsed in a process pool,
+    so extraction scales across CPU cores. Only a few urls per worker are in flight at once,
+    so urls can be a lazy iterable.
+
+    :param urls: Urls of offer pages
+    :param workers: Number of fetching threads, defaults to POOL_SIZE
+    :param processes: Number of parsing processes, parsing is done in fetching threads when not given
+    :param record: Yield compact Offer records instead of dictionaries. See :class:'olx.offer.Offer'
+    :type urls: iterable
+    :type workers: int, None
+    :type processes: int, None
+    :type record: bool
+    :return: Generator of (url, offer details) tuples in completion order. Offer details are None if offer is not
+    available anymore or it failed to load.
+    :rtype: generator
+
+    :except: Errors are logged and reported as None for failed url only
+    """
+    workers = workers or POOL_SIZE
+    urls = iter(urls)
+    thread_pool = ThreadPoolExecutor(max_workers=workers)
+    process_pool = ProcessPoolExecutor(max_workers=processes) if processes else None
+    pending = {}
+
+    def submit(batch_size):
+        for url in islice(urls, batch_size):
+            pending[thread_pool.submit(_fetch_and_parse_offer, url, process_pool, record)] = url
+
+    try:
+        submit(workers * 2)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            submit(len(done))
+            for future in done:
+                url = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    log.warning("Parsing offer {0} failed. Error: {1}".format(url, e))
+                    result = None
+                yield url, result
+    finally:
+        for future in pending:
+            future.cancel()
+        thread_pool.shutdown(wait=True)
+        if process_pool is not None:
+            process_pool.shutdown(wait=True)
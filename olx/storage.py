@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from olx.export import COLUMNS, SCHEMA, offer_row
+
+log = logging.getLogger(__file__)
+
+# Offers buffered before they are written in one transaction
+BATCH_SIZE = int(os.environ.get("OLX_STORAGE_BATCH_SIZE", 500))
+
+SQL_TYPES = {"string": "TEXT", "int64": "INTEGER", "float64": "REAL", "bool": "INTEGER", "timestamp": "INTEGER",
+             "list": "TEXT"}
+INDEXED_COLUMNS = ("price", "city", "date_added")
+
+
+class OfferStore(object):
+    """ SQLite store of parsed offers keyed by add_id
+
+    Offers are buffered and upserted in batched transactions, database runs in WAL mode, so readers are not blocked
+    by crawler writing to it. Store is safe to share between threads.
+
+    Store can be passed as seen_ids of incremental crawl, see :meth:'olx.category.iter_category'.
+    Membership is checked with indexed lookup, so stored ids are not loaded into memory.
+
+    :Example:
+
+    >> with OfferStore("offers.db") as store:
+    >>     store.write_all(iter_category(url=url, parse=True, seen_ids=store))
+    """
+
+    def __init__(self, path, batch_size=None):
+        """
+        :param path: Database file path
+        :param batch_size: Offers written in one transaction, defaults to BATCH_SIZE
+        :type path: str
+        :type batch_size: int, None
+        """
+        self.path = path
+        self.batch_size = batch_size or BATCH_SIZE
+        self._buffer = {}
+        self._seen = set()
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        columns = ", ".join("{0} {1}{2}".format(name, SQL_TYPES[kind], " PRIMARY KEY" if name == "add_id" else "")
+                            for name, kind in SCHEMA)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS offers ({0})".format(columns))
+            for column in INDEXED_COLUMNS:
+                self._connection.execute("CREATE INDEX IF NOT EXISTS offers_{0} ON offers ({0})".format(column))
+        self._upsert = "INSERT OR REPLACE INTO offers ({0}) VALUES ({1})".format(
+            ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS)))
+
+    def add(self, add_id):
+        """ Marks ad id as seen, so store can be used as seen_ids of :meth:'olx.category.iter_category'
+
+        Id is remembered until store is closed, offers are persisted with :meth:'add_offer' and :meth:'write_all'.
+
+        :param add_id: Offer id
+        :type add_id: str
+        """
+        with self._lock:
+            self._seen.add(add_id)
+
+    def add_offer(self, offer):
+        """ Buffers offer, buffered offers are written when batch is full
+
+        Offer with add_id which is already stored replaces it.
+
+        :param offer: Offer details dictionary or record, None is skipped
+        :type offer: dict, olx.offer.Offer, None
+        """
+        if offer is None:
+            return
+        row = offer_row(offer)
+        with self._lock:
+            self._buffer[row[0]] = row
+            if len(self._buffer) >= self.batch_size:
+                self.flush()
+
+    def write_all(self, offers):
+        """ Stores every offer from iterable
+
+        :param offers: Offer details dictionaries or records
+        :type offers: iterable
+        :return: Number of stored offers
+        :rtype: int
+        """
+        for offer in offers:
+            self.add_offer(offer)
+        self.flush()
+        return len(self)
+
+    def flush(self):
+        """ Writes buffered offers in one transaction """
+        with self._lock:
+            if not self._buffer:
+                return
+            images = COLUMNS.index("images")
+            rows = [row[:images] + (json.dumps(row[images]) if row[images] is not None else None,) + row[images + 1:]
+                    for row in self._buffer.values()]
+            with self._connection:
+                self._connection.executemany(self._upsert, rows)
+            log.debug("Stored {0} offers".format(len(rows)))
+            self._buffer = {}
+
+    def __contains__(self, add_id):
+        with self._lock:
+            if add_id in self._buffer or add_id in self._seen:
+                return True
+            return self._connection.execute("SELECT 1 FROM offers WHERE add_id = ?", (add_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            self.flush()
+            return self._connection.execute("SELECT COUNT(*) FROM offers").fetchone()[0]
+
+    def known_ids(self):
+        """ Returns ids of stored offers
+
+        Set can be used as seen_ids of incremental crawl instead of the store itself,
+        see :meth:'olx.category.iter_category'.
+
+        :return: Set of add_ids
+        :rtype: set
+        """
+        with self._lock:
+            self.flush()
+            return {row[0] for row in self._connection.execute("SELECT add_id FROM offers")}
+
+    def get(self, add_id):
+        """ Reads stored offer
+
+        :param add_id: Offer id
+        :type add_id: str
+        :return: Dictionary of stored columns or None if offer is not stored
+        :rtype: dict, None
+        """
+        with self._lock:
+            self.flush()
+            row = self._connection.execute("SELECT {0} FROM offers WHERE add_id = ?".format(", ".join(COLUMNS)),
+                                           (add_id,)).fetchone()
+        if row is None:
+            return None
+        offer = dict(zip(COLUMNS, row))
+        offer["furniture"] = bool(offer["furniture"]) if offer["furniture"] is not None else None
+        offer["images"] = json.loads(offer["images"]) if offer["images"] is not None else None
+        return offer
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,367 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+
+log = logging.getLogger(__file__)
+
+# Requests per second and burst size of token bucket
+RATE = float(os.environ.get("OLX_RATE", 10))
+BURST = int(os.environ.get("OLX_BURST", 10))
+
+# Concurrent requests per host
+MIN_CONCURRENCY = 1
+INITIAL_CONCURRENCY = int(os.environ.get("OLX_INITIAL_CONCURRENCY", 4))
+MAX_CONCURRENCY = int(os.environ.get("OLX_MAX_CONCURRENCY", 64))
+
+# Status codes OLX answers with when it throttles
+THROTTLE_STATUS_CODES = (403, 429, 503)
+
+# Pause used when throttled response has no Retry-After header
+DEFAULT_RETRY_AFTER = 5.0
+
+# Number of retries and base backoff delay in seconds per error class
+RETRIES = {
+    "connect": (3, 0.5),
+    "timeout": (2, 1.0),
+    "server": (3, 1.0),
+    "throttled": (2, DEFAULT_RETRY_AFTER),
+}
+MAX_BACKOFF = 60.0
+
+# Consecutive failures opening the circuit and seconds after which one trial request is let through
+FAILURE_THRESHOLD = int(os.environ.get("OLX_FAILURE_THRESHOLD", 10))
+RESET_TIMEOUT = float(os.environ.get("OLX_RESET_TIMEOUT", 30))
+# Seconds between checks of trial request made by another thread
+TRIAL_POLL_INTERVAL = 0.1
+
+
+def get_error_class(response=None, exception=None):
+    """ Classifies failed request for retry policy
+
+    :param response: Response from host
+    :param exception: Exception raised by request
+    :type response: requests.Response, None
+    :type exception: Exception, None
+    :return: One of "connect", "timeout", "server", "throttled" or None if request didn't fail with transient error
+    :rtype: str, None
+    """
+    if exception is not None:
+        if isinstance(exception, requests.ConnectTimeout):
+            return "connect"
+        if isinstance(exception, requests.Timeout):
+            return "timeout"
+        if isinstance(exception, requests.ConnectionError):
+            return "connect"
+        return None
+    if response is None:
+        return None
+    if response.status_code in THROTTLE_STATUS_CODES:
+        return "throttled"
+    if response.status_code >= 500:
+        return "server"
+    return None
+
+
+def parse_retry_after(value):
+    """ Reads Retry-After header
+
+    :param value: Header value, number of seconds or HTTP date
+    :type value: str, None
+    :return: Number of seconds to wait or None if header is missing or invalid
+    :rtype: float, None
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_tz(value)
+        return max(email.utils.mktime_tz(date) - time.time(), 0.0) if date else None
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+class RateLimiter(object):
+    """ Thread-safe token bucket """
+
+    def __init__(self, rate=RATE, burst=BURST):
+        """
+        :param rate: Tokens added per second, limiting is disabled when it's 0 or None
+        :param burst: Bucket size
+        :type rate: float, None
+        :type burst: int
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _delay(self):
+        now = time.time()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if not self.rate:
+            return 0.0
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """ Blocks until token is available and takes it """
+        while True:
+            with self._lock:
+                delay = self._delay()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """ Stops handing out tokens for given time
+
+        :param seconds: Pause length
+        :type seconds: float
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+            self._tokens = 0.0
+
+
+class AdaptiveConcurrency(object):
+    """ Concurrency limit controlled with additive increase and multiplicative decrease (AIMD)
+
+    Limit grows by one after limit successful responses in a row and it's multiplied by decrease factor
+    on every throttling response.
+    """
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY, decrease=0.5):
+        """
+        :param initial: Initial limit
+        :param minimum: Minimal limit
+        :param maximum: Maximal limit
+        :param decrease: Factor applied to limit when requests are throttled
+        :type initial: int
+        :type minimum: int
+        :type maximum: int
+        :type decrease: float
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """ Blocks until number of requests in flight is below limit """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            previous = int(self.limit)
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            if int(self.limit) > previous:
+                self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class HostThrottle(object):
+    """ Rate limiter and adaptive concurrency limit of one host
+
+    :Example:
+
+    >> with throttle:
+    >>     response = session.get(url)
+    >> throttle.record(response)
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY,
+                 maximum=MAX_CONCURRENCY):
+        self.rate_limiter = RateLimiter(rate, burst)
+        self.concurrency = AdaptiveConcurrency(initial, minimum, maximum)
+        self.throttled = 0
+
+    def __enter__(self):
+        self.concurrency.acquire()
+        try:
+            self.rate_limiter.acquire()
+        except BaseException:
+            self.concurrency.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.concurrency.release()
+
+    def record(self, response):
+        """ Adjusts limits to response
+
+        :param response: Response from host
+        :type response: requests.Response
+        :return: True if response is a throttling signal
+        :rtype: bool
+        """
+        if response.status_code not in THROTTLE_STATUS_CODES:
+            if response.status_code < 500:
+                self.concurrency.on_success()
+            return False
+        self.throttled += 1
+        self.concurrency.on_throttle()
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        self.rate_limiter.pause(retry_after if retry_after is not None else DEFAULT_RETRY_AFTER)
+        log.warning("Throttled by host with status {0}, concurrency limit is {1}".format(
+            response.status_code, int(self.concurrency.limit)))
+        return True
+
+
+class RetryPolicy(object):
+    """ Exponential backoff with full jitter, configured separately per error class """
+
+    def __init__(self, retries=None, max_backoff=MAX_BACKOFF):
+        """
+        :param retries: Dictionary of error class to tuple of number of retries and base delay in seconds,
+        missing classes use RETRIES. See :meth:'olx.throttle.get_error_class'
+        :param max_backoff: Maximal delay in seconds
+        :type retries: dict, None
+        :type max_backoff: float
+        """
+        self.retries = dict(RETRIES, **(retries or {}))
+        self.max_backoff = max_backoff
+
+    def delay(self, error_class, attempt):
+        """ Returns delay before next retry
+
+        :param error_class: Error class of failed attempt
+        :param attempt: Number of failed attempts so far, starting from 0
+        :type error_class: str
+        :type attempt: int
+        :return: Delay in seconds or None if request shouldn't be retried
+        :rtype: float, None
+        """
+        retries, base_delay = self.retries.get(error_class, (0, 0))
+        if attempt >= retries:
+            return None
+        return random.uniform(0, min(self.max_backoff, base_delay * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """ Stops requests to failing host
+
+    Circuit opens after threshold consecutive failures. When it's open, requests are rejected (or wait,
+    see :meth:'wait') until reset timeout passes, then one trial request is let through. Its success closes
+    the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        """
+        :param failure_threshold: Consecutive failures opening the circuit
+        :param reset_timeout: Seconds after which trial request is let through
+        :type failure_threshold: int
+        :type reset_timeout: float
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Checks if request can be made
+
+        :rtype: bool
+        """
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.time() - self._opened_at >= self.reset_timeout:
+                self.state = "half-open"
+                return True
+            return False
+
+    def wait(self):
+        """ Blocks until request can be made
+
+        Request waiting for circuit to close gives up when trial request fails and circuit opens again,
+        so requests to dead host don't wait forever.
+
+        :return: True when request can be made, False when trial request failed meanwhile
+        :rtype: bool
+        """
+        with self._lock:
+            opened_at = self._opened_at
+        while True:
+            with self._lock:
+                if self.state == "closed":
+                    return True
+                if self._opened_at != opened_at:
+                    return False
+                delay = TRIAL_POLL_INTERVAL
+                if self.state == "open":
+                    delay = self._opened_at + self.reset_timeout - time.time()
+                    if delay <= 0:
+                        self.state = "half-open"
+                        return True
+            time.sleep(delay)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = "closed"
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= self.failure_threshold:
+                self._open()
+
+    def record_throttle(self):
+        """ Throttling response doesn't count as failure, but it doesn't close the circuit either,
+        so failed trial request opens it again """
+        with self._lock:
+            if self.state == "half-open":
+                self._open()
+
+    def record(self, error_class):
+        """ Records result of request let through by :meth:'allow'
+
+        :param error_class: Error class of request, None for success. See :meth:'olx.throttle.get_error_class'
+        :type error_class: str, None
+        """
+        if error_class is None:
+            self.record_success()
+        elif error_class == "throttled":
+            self.record_throttle()
+        else:
+            self.record_failure()
+
+    def _open(self):
+        if self.state != "open":
+            log.warning("Circuit opened after {0} failures".format(self.failures))
+        self.state = "open"
+        self._opened_at = time.time()
@@ -1,21 +1,82 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import json
 import logging
+import os
+import re
 import sys
+import threading
+import time
 
 import requests
+from bs4 import BeautifulSoup
+from bs4.element import Tag
+from requests.adapters import HTTPAdapter
 
-from olx import BASE_URL
-from scrapper_helpers.utils import caching, get_random_user_agent, key_sha1, replace_all
+from olx import BASE_URL, metrics
+from olx.cache import DiskStore, ResponseCache, response_from_entry, validation_headers
+from olx.throttle import CircuitBreaker, HostThrottle, RetryPolicy, get_error_class
+from scrapper_helpers.utils import get_random_user_agent, replace_all
 
 if sys.version_info < (3, 2):
-    from urllib import quote
+    from urllib import quote, unquote, urlencode
+    from urlparse import parse_qsl, urlparse, urlunparse
 else:
-    from urllib.parse import quote
+    from urllib.parse import parse_qsl, quote, unquote, urlencode, urlparse, urlunparse
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+# Offer id token in offer url, e.g. IDnT89A in .../gdansk-przymorze-dla-studentow-CID3-IDnT89A.html
+OFFER_ID_PATTERN = re.compile(r"-ID([0-9A-Za-z]+)\.html")
+
+# Inline script payloads read straight from raw page markup, see :meth:'olx.utils.find_script_data'
+SCRIPT_PATTERNS = {
+    "pageView": re.compile(br'"pageView"\s*:\s*(\{[^{}]*\})'),
+    "GPT.targeting": re.compile(br'GPT\.targeting\s*=\s*(\{.*?\})\s*;', re.DOTALL),
+    "page_count": re.compile(br'["\']?page_count["\']?\s*:\s*["\']?(\d+)(?=\D)'),
+}
+
+# Bytes read at once by partial fetch, see :meth:'olx.utils.get_content_for_url'
+CHUNK_SIZE = int(os.environ.get("OLX_CHUNK_SIZE", 16384))
+
+# Query parameters which don't change page content
+TRACKING_PARAMETERS = ("fbclid", "gclid", "reason", "search_reason")
+TRACKING_PREFIXES = ("utm_",)
 
 POLISH_CHARACTERS_MAPPING = {"ą": "a", "ć": "c", "ę": "e", "ł": "l", "ń": "n", "ó": "o", "ś": "s", "ż": "z", "ź": "z"}
 
+PARSER_BACKENDS = ("html.parser", "lxml", "selectolax")
+PARSER_BACKEND = os.environ.get("OLX_PARSER", "html.parser")
+
+POOL_SIZE = int(os.environ.get("OLX_POOL_SIZE", 10))
+# (connect, read) timeout in seconds
+TIMEOUT = (float(os.environ.get("OLX_CONNECT_TIMEOUT", 5)), float(os.environ.get("OLX_READ_TIMEOUT", 30)))
+
+_session = None
+_session_lock = threading.Lock()
+
+THROTTLING = os.environ.get("OLX_THROTTLING", "1") != "0"
+_throttle_settings = {}
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+RETRY_POLICY = RetryPolicy()
+CIRCUIT_BREAKING = os.environ.get("OLX_CIRCUIT_BREAKING", "1") != "0"
+_circuit_settings = {}
+_circuits = {}
+
+# In DEBUG mode every response is kept on disk and never expires
+CACHE = ResponseCache(disk=DiskStore(), listing_ttl=None, offer_ttl=None) if os.environ.get("DEBUG") else None
+
 log = logging.getLogger(__file__)
 
 
@@ -42,6 +103,87 @@ def city_name(city):
         return output
 
 
+def set_parser_backend(backend):
+    """ Sets HTML parser backend used by every extractor
+
+    Default backend can also be chosen with OLX_PARSER environmental variable.
+
+    :param backend: One of "html.parser", "lxml" or "selectolax"
+    :type backend: str
+
+    :except: ValueError when backend is not supported
+    """
+    global PARSER_BACKEND
+    if backend not in PARSER_BACKENDS:
+        raise ValueError("Parser backend {0} is not supported. Use one of: {1}".format(
+            backend, ", ".join(PARSER_BACKENDS)))
+    PARSER_BACKEND = backend
+
+
+def get_html_parser(markup, backend=None):
+    """ Creates BeautifulSoup tree for given markup
+
+    Already parsed trees and their tags are returned unchanged, so one document can be shared between extractors
+    instead of being serialized and parsed again by each of them.
+    selectolax backend builds BeautifulSoup trees with lxml (html.parser if lxml is not installed),
+    it is only used directly by extractors that support it. See :meth:'olx.utils.get_fast_parser'.
+
+    :param markup: Page markup or already parsed tree
+    :param backend: Parser backend, defaults to PARSER_BACKEND
+    :type markup: str, bytes, bs4.element.Tag
+    :type backend: str, None
+    :return: Parsed tree
+    :rtype: bs4.element.Tag
+    """
+    if isinstance(markup, Tag):
+        return markup
+    backend = backend or PARSER_BACKEND
+    if backend == "selectolax":
+        backend = "lxml" if lxml is not None else "html.parser"
+    return BeautifulSoup(markup, backend)
+
+
+def get_fast_parser(markup, backend=None):
+    """ Creates selectolax tree for given markup
+
+    :param markup: Page markup
+    :param backend: Parser backend, defaults to PARSER_BACKEND
+    :type markup: str, bytes, bs4.element.Tag
+    :type backend: str, None
+    :return: selectolax tree or None if selectolax backend is not enabled, not installed or markup is already parsed
+    :rtype: selectolax.parser.HTMLParser, None
+    """
+    if (backend or PARSER_BACKEND) != "selectolax" or HTMLParser is None or isinstance(markup, Tag):
+        return None
+    return HTMLParser(markup)
+
+
+def find_script_data(markup, name):
+    """ Reads payload of inline script straight from raw markup, without building HTML tree
+
+    :param markup: Raw page markup. Already parsed trees are not searched.
+    :param name: One of SCRIPT_PATTERNS keys: "pageView", "GPT.targeting" or "page_count"
+    :type markup: str, bytes, bs4.element.Tag
+    :type name: str
+    :return: Decoded JSON object (int for page_count) or None if payload wasn't found or is invalid,
+    caller should fall back to tree parser then
+    :rtype: dict, int, None
+    """
+    if isinstance(markup, Tag) or not markup:
+        return None
+    if not isinstance(markup, bytes):
+        markup = markup.encode("utf-8")
+    match = SCRIPT_PATTERNS[name].search(markup)
+    if match is None:
+        return None
+    if name == "page_count":
+        return int(match.group(1))
+    try:
+        return json.loads(match.group(1).decode("utf-8"))
+    except ValueError:
+        return None
+
+
 def get_search_filter(filter_name, filter_value):
     """ Generates url search filter
 
@@ -108,28 +250,362 @@ def get_url(main_category=None, sub_category=None, detail_category=None, region=
     else:
         url = "/".join(parameters)
     if user_url:
-        url = user_url + "?" if "search" not in user_url else user_url + "&"
+        url = user_url + "&" if "?" in user_url else user_url + "?"
     for k, v in filters.items():
         url += get_search_filter(k, v) + "&"
     if page is not None:
         url += "page={0}".format(page)
-    return url
+    return canonical_url(url)
+
+
+def canonical_url(url):
+    """ Normalizes url, so logically identical urls are equal
+
+    Query parameters are sorted and consistently encoded, tracking parameters and fragment are dropped.
+    Path segments of search urls are normalized like city names, see :meth:'olx.utils.city_name'.
+    Search query segment ("q-...") and offer urls keep their text, because it's searched for
+    and offer id is case sensitive.
+
+    :param url: Url
+    :type url: str
+    :return: Canonical url
+    :rtype: str
+
+    :Example:
+
+    >> canonical_url("https://www.olx.pl/nieruchomosci/Gdańsk/?page=2&search%5Bprivate_business%5D=private&")
+    "https://www.olx.pl/nieruchomosci/gdansk/?page=2&search%5Bprivate_business%5D=private"
+    """
+    parts = urlparse(url)
+    path = parts.path
+    if "/oferta/" not in path:
+        path = "/".join(quote(unquote(segment) if segment.startswith("q-") else city_name(unquote(segment)))
+                        for segment in path.split("/"))
+    parameters = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                  if name not in TRACKING_PARAMETERS and not name.startswith(TRACKING_PREFIXES)]
+    return urlunparse((parts.scheme.lower(), parts.netloc.lower(), path, parts.params, urlencode(sorted(parameters)),
+                       ""))
+
+
+def get_offer_id(url):
+    """ Reads offer id from offer url
+
+    Promoted offers repeat on every search page and the same offer url comes with different fragments,
+    offer id is the same for all of them.
+
+    :param url: Offer url
+    :type url: str
+    :return: Offer id or None if url has no id token
+    :rtype: str, None
+
+    :Example:
+
+    >> get_offer_id("https://www.olx.pl/oferta/gdansk-przymorze-dla-studentow-CID3-IDnT89A.html#1d9db51b24")
+    "nT89A"
+    """
+    match = OFFER_ID_PATTERN.search(url or "")
+    return match.group(1) if match else None
+
+
+def create_session(pool_size=None):
+    """ Creates requests session with keep-alive connection pool
+
+    :param pool_size: Maximal number of connections kept open per host, defaults to POOL_SIZE
+    :type pool_size: int, None
+    :return: New session
+    :rtype: requests.Session
+    """
+    pool_size = pool_size or POOL_SIZE
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    """ Returns session shared by every request
+
+    Session is created on first use with :meth:'olx.utils.create_session'.
+
+    :return: Shared session
+    :rtype: requests.Session
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
 
+def set_session(session=None, pool_size=None):
+    """ Replaces session shared by every request
 
-@caching(key_func=key_sha1)
-def get_content_for_url(url):
+    :param session: User defined session. New one is created when it's not given.
+    :param pool_size: Connection pool size for created session. See :meth:'olx.utils.create_session'
+    :type session: requests.Session, None
+    :type pool_size: int, None
+    :return: Shared session
+    :rtype: requests.Session
+    """
+    global _session
+    with _session_lock:
+        previous, _session = _session, session or create_session(pool_size)
+    if previous is not None and previous is not _session:
+        previous.close()
+    return _session
+
+
+def set_timeout(connect=None, read=None):
+    """ Sets default timeouts of every request
+
+    :param connect: Connect timeout in seconds
+    :param read: Read timeout in seconds
+    :type connect: float, None
+    :type read: float, None
+    """
+    global TIMEOUT
+    TIMEOUT = (connect if connect is not None else TIMEOUT[0], read if read is not None else TIMEOUT[1])
+
+
+def set_throttling(enabled=True, **settings):
+    """ Enables or disables per host rate limiting and adaptive concurrency
+
+    :param enabled: Enable throttling
+    :param settings: Keyword arguments of :class:'olx.throttle.HostThrottle', e.g. rate, burst, maximum
+    :type enabled: bool
+    :type settings: dict
+    """
+    global THROTTLING, _throttle_settings
+    with _throttles_lock:
+        THROTTLING = enabled
+        _throttle_settings = settings
+        _throttles.clear()
+
+
+def get_throttle(url):
+    """ Returns throttle of url host
+
+    :param url: Website url
+    :type url: str
+    :return: Throttle shared by every request to the host or None if throttling is disabled
+    :rtype: olx.throttle.HostThrottle, None
+    """
+    if not THROTTLING:
+        return None
+    host = urlparse(url).netloc
+    with _throttles_lock:
+        throttle = _throttles.get(host)
+        if throttle is None:
+            throttle = _throttles[host] = HostThrottle(**_throttle_settings)
+    return throttle
+
+
+def set_retry_policy(policy=None):
+    """ Sets retry policy of failed requests
+
+    :Example:
+
+    >> set_retry_policy(RetryPolicy({"timeout": (5, 2.0), "throttled": (0, 0)}))
+
+    :param policy: Retry policy, failed requests are not retried when it's not given
+    :type policy: olx.throttle.RetryPolicy, None
+    """
+    global RETRY_POLICY
+    RETRY_POLICY = policy
+
+
+def set_circuit_breaking(enabled=True, **settings):
+    """ Enables or disables per host circuit breaker
+
+    :param enabled: Enable circuit breaking
+    :param settings: Keyword arguments of :class:'olx.throttle.CircuitBreaker'
+    :type enabled: bool
+    :type settings: dict
+    """
+    global CIRCUIT_BREAKING, _circuit_settings
+    with _throttles_lock:
+        CIRCUIT_BREAKING = enabled
+        _circuit_settings = settings
+        _circuits.clear()
+
+
+def get_circuit_breaker(url):
+    """ Returns circuit breaker of url host
+
+    :param url: Website url
+    :type url: str
+    :return: Circuit breaker shared by every request to the host or None if circuit breaking is disabled
+    :rtype: olx.throttle.CircuitBreaker, None
+    """
+    if not CIRCUIT_BREAKING:
+        return None
+    host = urlparse(url).netloc
+    with _throttles_lock:
+        circuit = _circuits.get(host)
+        if circuit is None:
+            circuit = _circuits[host] = CircuitBreaker(**_circuit_settings)
+    return circuit
+
+
+def read_until(response, markers, chunk_size=None):
+    """ Reads streamed response body until every marker is found
+
+    Rest of the body is not downloaded, connection is closed instead. Read part is set as response content.
+
+    :param response: Response of request made with stream=True
+    :param markers: SCRIPT_PATTERNS keys, see :meth:'olx.utils.find_script_data'
+    :param chunk_size: Bytes read at once, defaults to CHUNK_SIZE
+    :type response: requests.Response
+    :type markers: tuple
+    :type chunk_size: int, None
+    :return: Response with partial attribute set to True if body wasn't read to the end
+    :rtype: requests.Response
+    """
+    content = bytearray()
+    response.partial = False
+    try:
+        for chunk in response.iter_content(chunk_size or CHUNK_SIZE):
+            content += chunk
+            if all(SCRIPT_PATTERNS[marker].search(content) for marker in markers):
+                response.partial = True
+                break
+    finally:
+        response._content = bytes(content)
+        response._content_consumed = True
+        response.close()
+    return response
+
+
+def _request(session, url, headers, timeout, markers=None):
+    throttle = get_throttle(url)
+    stream = markers is not None
+    if throttle is None:
+        with metrics.timer("olx_fetch_seconds"):
+            response = session.get(url, headers=headers, timeout=timeout, stream=stream)
+            return read_until(response, markers) if stream else response
+    with throttle:
+        with metrics.timer("olx_fetch_seconds"):
+            response = session.get(url, headers=headers, timeout=timeout, stream=stream)
+            if stream:
+                read_until(response, markers)
+    throttle.record(response)
+    return response
+
+
+def set_cache(cache=None):
+    """ Sets response cache used by :meth:'olx.utils.get_content_for_url'
+
+    :Example:
+
+    >> set_cache(ResponseCache(memory_size=256 * 1024 * 1024, disk=DiskStore("/var/cache/pyolx"), offer_ttl=3600))
+
+    :param cache: Response cache, caching is disabled when it's not given
+    :type cache: olx.cache.ResponseCache, None
+    """
+    global CACHE
+    CACHE = cache
+
+
+def get_content_for_url(url, session=None, timeout=None, markers=None):
     """ Connects with given url
 
-    If environmental variable DEBUG is True it will cache response for url in /var/temp directory
+    Connections are reused from shared session pool, see :meth:'olx.utils.get_session'.
+    Requests are rate limited per host and their concurrency adapts to throttling responses (403, 429, 503),
+    see :meth:'olx.utils.set_throttling'.
+    Connection errors, timeouts, server errors and throttling responses are retried with jittered exponential backoff,
+    see :meth:'olx.utils.set_retry_policy'. Requests to host failing repeatedly wait until its circuit breaker
+    lets trial request through and are skipped only when the trial fails, see :meth:'olx.utils.set_circuit_breaking'.
+    Url is normalized first, see :meth:'olx.utils.canonical_url'.
+    Fetch latency, downloaded bytes, errors and cache lookups are recorded, see :mod:'olx.metrics'.
+    Fresh responses are served from CACHE when it's set, see :meth:'olx.utils.set_cache'.
+    Expired responses are revalidated with If-None-Match and If-Modified-Since headers, on 304 Not Modified
+    cached response is served with not_modified attribute set to True.
+    If environmental variable DEBUG is True it will cache response for url in OLX_CACHE_DIR (system temp directory
+    by default), see :class:'olx.cache.DiskStore'
+    When markers are given, body is streamed and download stops as soon as every marker is found,
+    see :meth:'olx.utils.read_until'. Such partial responses are not cached.
+
+    :Example:
+
+    >> get_content_for_url(url, markers=("page_count", "GPT.targeting"))
 
     :param url: Website url
+    :param session: Session used instead of shared one
+    :param timeout: (connect, read) timeout in seconds, defaults to TIMEOUT
+    :param markers: SCRIPT_PATTERNS keys of payloads which are needed from the page
     :type url: str
-    :return: Response for requested url
+    :type session: requests.Session, None
+    :type timeout: tuple, float, None
+    :type markers: tuple, None
+    :return: Response for requested url or None if request failed
     """
-    response = requests.get(url, headers={'User-Agent': get_random_user_agent()})
+    url = canonical_url(url)
+    cache, entry = CACHE, None
+    headers = {'User-Agent': get_random_user_agent()}
+    if cache is not None:
+        entry, fresh = cache.lookup(url)
+        if fresh:
+            metrics.increment("olx_cache_requests_total", result="hit")
+            return response_from_entry(entry)
+        metrics.increment("olx_cache_requests_total", result="stale" if entry is not None else "miss")
+        if entry is not None:
+            headers.update(validation_headers(entry))
+    session = session or get_session()
+    circuit = get_circuit_breaker(url)
+    attempt = 0
+    while True:
+        if circuit is not None and not circuit.wait():
+            metrics.increment("olx_fetch_errors_total", error_class="circuit_open")
+            log.warning('Request for {0} skipped, host is still failing after trial request'.format(url))
+            return None
+        response, error = None, None
+        # Every request let through by circuit breaker is recorded, even when it raises unexpected error
+        error_class = "unexpected"
+        try:
+            try:
+                response = _request(session, url, headers, timeout or TIMEOUT, markers)
+            except requests.RequestException as e:
+                error = e
+            error_class = get_error_class(response, error)
+        finally:
+            if circuit is not None:
+                circuit.record(error_class)
+        if error_class is not None:
+            metrics.increment("olx_fetch_errors_total", error_class=error_class)
+        delay = RETRY_POLICY.delay(error_class, attempt) if error_class and RETRY_POLICY else None
+        if delay is None:
+            break
+        attempt += 1
+        log.info('Retrying request for {0} in {1:.2f}s ({2} error)'.format(url, delay, error_class))
+        time.sleep(delay)
+    if error is not None:
+        log.warning('Request for {0} failed. Error: {1}'.format(url, error))
+        return None
+    if response.status_code == 304 and entry is not None:
+        metrics.increment("olx_cache_requests_total", result="revalidated")
+        return cache.revalidate(url, entry, response)
+    metrics.increment("olx_downloaded_bytes_total", len(response.content))
     try:
         response.raise_for_status()
     except requests.HTTPError as e:
         log.warning('Request for {0} failed. Error: {1}'.format(url, e))
         return None
+    if cache is not None and not getattr(response, "partial", False):
+        cache.set(url, response)
     return response
+
+
+def set_extracted(url, data):
+    """ Attaches data extracted from page to its cached response
+
+    Does nothing when cache is disabled. See :meth:'olx.cache.ResponseCache.set_extracted'
+
+    :param url: Website url
+    :param data: Extracted data
+    :type url: str
+    :type data: dict
+    """
+    if CACHE is not None:
+        CACHE.set_extracted(canonical_url(url), data)
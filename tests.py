@@ -1,24 +1,52 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import asyncio
+import io
+import os
 import sys
+from itertools import islice
 
 import pytest
 from bs4 import BeautifulSoup
 
 import olx
+import olx.cache
 import olx.category
+import olx.export
+import olx.metrics
 import olx.offer
+import olx.storage
+import olx.throttle
 import olx.utils
 
+import loadtest
+from conftest import read_fixture
+
 if sys.version_info < (3, 3):
     from mock import mock
 else:
     from unittest import mock
 
+# olx.aio uses async/await syntax
+if sys.version_info >= (3, 5):
+    import olx.aio
+
+requires_aio = pytest.mark.skipif(sys.version_info < (3, 5), reason="olx.aio requires Python 3.5")
+
 GDANSK_URL = "https://www.olx.pl/nieruchomosci/mieszkania/wynajem/gdansk/"
 OFFER_URL = "https://www.olx.pl/oferta/gdansk-przymorze-dla-studentow-CID3-IDnT89A.html#1d9db51b24"
 
 
+@pytest.fixture(autouse=True)
+def host_state():
+    # Circuit breakers and throttles are shared per host, so failures of one test don't leak into another
+    olx.utils.set_circuit_breaking()
+    olx.utils.set_throttling()
+    yield
+    olx.utils.set_circuit_breaking()
+    olx.utils.set_throttling()
+
+
 @pytest.mark.parametrize("filter_name,filter_value", [
     ("[filter_float_price:from]", 2000),
     ("[filter_enum_floor_select][0]", 2),
@@ -30,10 +58,9 @@ def test_get_search_filter(filter_name, filter_value):
     assert "search%5B" in olx.utils.get_search_filter(filter_name, filter_value)
 
 
-response = olx.utils.get_content_for_url(GDANSK_URL)
-html_parser = BeautifulSoup(response.content, "html.parser")
-offers = html_parser.find_all(class_='offer')
-parsed_urls = [OFFER_URL]
+@pytest.fixture
+def category_markup():
+    return read_fixture("category.html")
 
 
 @pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
@@ -48,9 +75,16 @@ def test_city_name(city):
     assert " " not in result and result.islower()
 
 
-@pytest.mark.parametrize("offers", [response.content])
-def test_parse_available_offers(offers):
-    assert olx.category.parse_available_offers(offers)
+def test_parse_available_offers(category_markup):
+    assert olx.category.parse_available_offers(category_markup)
+
+
+def test_parse_search_page(category_markup):
+    markup = category_markup
+    result = olx.category.parse_search_page(markup)
+    assert result["offers"] == olx.category.parse_available_offers(markup)
+    assert result["ads_count"] == olx.category.parse_ads_count(markup)
+    assert result["page_count"] == olx.category.get_page_count(markup)
 
 
 @pytest.mark.parametrize("maincat,subcat,detailcat,region,filters", [
@@ -58,12 +92,11 @@ def test_parse_available_offers(offers):
 ])
 def test_get_url(maincat, subcat, detailcat, region, filters):
     assert olx.utils.get_url(maincat, subcat, detailcat, region, **filters) == \
-           "https://www.olx.pl/nieruchomosci/mieszkania/wynajem/gdansk/?search%5Bfilter_float_price%3Afrom%5D=2000&"
+           "https://www.olx.pl/nieruchomosci/mieszkania/wynajem/gdansk/?search%5Bfilter_float_price%3Afrom%5D=2000"
 
 
-@pytest.mark.parametrize("page_count", [response.content])
-def test_get_page_count(page_count):
-    assert olx.category.get_page_count(page_count) >= 10
+def test_get_page_count(category_markup):
+    assert olx.category.get_page_count(category_markup) >= 10
 
 
 @pytest.mark.parametrize("test_url", ['https://www.olx.pl/', GDANSK_URL])
@@ -71,18 +104,16 @@ def test_get_conntent_for_url(test_url):
     assert olx.utils.get_content_for_url(test_url)
 
 
-@pytest.mark.parametrize("offer_url", [
-    str(offer) for offer in offers if offer
-])
-def test_parse_offer_url(offer_url):
-    olx.category.parse_offer_url(offer_url)
+def test_parse_offer_url(category_markup):
+    offers = BeautifulSoup(category_markup, "html.parser").find_all(class_='offer')
+    assert offers
+    for offer in offers:
+        assert olx.category.parse_offer_url(str(offer))
 
 
 @pytest.fixture
 def offer_parser():
-    response = olx.utils.get_content_for_url(OFFER_URL)
-    html_parser = BeautifulSoup(response.content, "html.parser")
-    return html_parser
+    return BeautifulSoup(read_fixture("offer.html"), "html.parser")
 
 
 @pytest.fixture
@@ -122,14 +153,27 @@ def test_get_date_added(parsed_body):
 
 @pytest.mark.parametrize("offer_url", [OFFER_URL])
 def test_parse_offer(offer_url):
-    assert isinstance(olx.offer.parse_offer(offer_url), (dict, type(None)))
+    with mock.patch("olx.offer.get_content_for_url", return_value=fixture_response("offer.html")):
+        assert olx.offer.parse_offer(offer_url)["add_id"] == "393658437"
 
 
-html_parser = BeautifulSoup(olx.utils.get_content_for_url(OFFER_URL).content, "html.parser")
-data_dict = olx.offer.get_gpt_script(str(html_parser.body))
+@pytest.mark.parametrize("extractor", [
+    olx.offer.get_title, olx.offer.get_gps, olx.offer.get_poster_name, olx.offer.get_surface,
+    olx.offer.parse_description, olx.offer.get_img_url, olx.offer.get_date_added, olx.offer.parse_region,
+    olx.offer.get_gpt_script, olx.offer.get_additional_rent
+])
+def test_extractor_accepts_parsed_tree(extractor, offer_parser, parsed_body):
+    assert extractor(offer_parser.body) == extractor(parsed_body)
+
+
+def test_parse_offer_markup(offer_parser):
+    result = olx.offer.parse_offer_markup(offer_parser, OFFER_URL)
+    assert result == olx.offer.parse_offer_markup(str(offer_parser), OFFER_URL)
+    assert result["url"] == OFFER_URL
 
 
 def test_parse_flat_data(parsed_body):
+    data_dict = olx.offer.get_gpt_script(parsed_body)
     test = olx.offer.parse_flat_data(parsed_body, data_dict)
     assert test["floor"] == 6
     assert test["rooms"] == 2
@@ -144,10 +188,813 @@ def test_parse_flat_data(parsed_body):
     ("nieruchomosci", "mieszkania", "wynajem", 'sopot'),
 ])
 def test_get_category(main_category, subcategory, detail_category, region):
-    with mock.patch("olx.utils.get_url") as get_url:
-        with mock.patch("olx.utils.get_content_for_url") as get_content_for_url:
-            with mock.patch("olx.category.parse_available_offers") as parse_available_offers:
-                parse_available_offers.return_value = olx.category.parse_available_offers(response.content)
-                get_content_for_url.return_value = response
-                get_url.return_value = olx.utils.get_url
-                olx.category.get_category(main_category, subcategory, detail_category, region)
+    with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+        get_content_for_url.return_value = fixture_response("category.html")
+        offers = olx.category.get_category(main_category, subcategory, detail_category, region)
+    assert len(offers) == 8
+    assert all("/{0}/".format(region) in call[0][0] for call in get_content_for_url.call_args_list)
+
+
+@pytest.mark.parametrize("fixture_name", ["category.html", "empty.html"])
+def test_parse_search_page_backends(parser_backend, fixture_name):
+    markup = read_fixture(fixture_name)
+    expected = olx.category.parse_search_page(olx.utils.get_html_parser(markup, "html.parser"))
+    assert olx.category.parse_search_page(markup) == expected
+
+
+def test_parse_offer_markup_backends(parser_backend):
+    markup = read_fixture("offer.html")
+    expected = olx.offer.parse_offer_markup(olx.utils.get_html_parser(markup, "html.parser"), OFFER_URL)
+    assert olx.offer.parse_offer_markup(markup, OFFER_URL) == expected
+
+
+def test_set_parser_backend_unknown():
+    with pytest.raises(ValueError):
+        olx.utils.set_parser_backend("html5")
+
+
+def test_create_session_pool_size():
+    session = olx.utils.create_session(pool_size=3)
+    assert session.get_adapter("https://www.olx.pl")._pool_maxsize == 3
+
+
+def test_get_session_is_shared():
+    assert olx.utils.get_session() is olx.utils.get_session()
+
+
+def test_get_content_for_url_custom_session():
+    session = mock.Mock()
+    session.get.return_value = make_response(OFFER_URL)
+    assert olx.utils.get_content_for_url(OFFER_URL, session=session, timeout=(1, 2)) is session.get.return_value
+    assert session.get.call_args[1]["timeout"] == (1, 2)
+
+
+def run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def make_response(url, content=b"<html></html>", headers=None):
+    response = olx.utils.requests.Response()
+    response.url = url
+    response.status_code = 200
+    response._content = content
+    response.headers = olx.utils.requests.structures.CaseInsensitiveDict(headers or {})
+    return response
+
+
+def fixture_response(name):
+    return make_response(GDANSK_URL, read_fixture(name))
+
+
+@requires_aio
+def test_aio_get_category():
+    with mock.patch("olx.aio.get_content_for_url") as get_content_for_url:
+        get_content_for_url.return_value = fixture_response("category.html")
+        offers = run_async(olx.aio.get_category(url=GDANSK_URL, concurrency=4, deduplicate=False))
+        unique_offers = run_async(olx.aio.get_category(url=GDANSK_URL, concurrency=4))
+    page_offers = olx.category.parse_available_offers(read_fixture("category.html"))
+    assert get_content_for_url.call_count == 24
+    assert offers == page_offers * 12
+    assert len(unique_offers) == 8
+
+
+@requires_aio
+def test_aio_executor_size():
+    with mock.patch("olx.aio.get_content_for_url", return_value=None):
+        run_async(olx.aio.get_category(url=GDANSK_URL, concurrency=olx.aio.CONCURRENCY + 10))
+    assert olx.aio.get_executor()._max_workers == olx.aio.CONCURRENCY + 10
+    assert olx.utils.get_session().get_adapter(GDANSK_URL)._pool_maxsize == olx.aio.CONCURRENCY + 10
+    olx.aio.set_concurrency(olx.aio.CONCURRENCY)
+    assert olx.aio.get_executor()._max_workers == olx.aio.CONCURRENCY
+
+
+@requires_aio
+def test_aio_parse_offer():
+    with mock.patch("olx.offer.get_content_for_url") as get_content_for_url:
+        get_content_for_url.return_value = fixture_response("offer.html")
+        result = run_async(olx.aio.parse_offer(OFFER_URL))
+    assert result == olx.offer.parse_offer_markup(read_fixture("offer.html"), OFFER_URL)
+
+
+@pytest.mark.parametrize("processes", [None, 2])
+def test_parse_offers(processes):
+    failing_url = OFFER_URL.replace("IDnT89A", "IDfail")
+
+    def get_content_for_url(url):
+        if url == failing_url:
+            raise olx.utils.requests.ConnectionError()
+        return fixture_response("offer.html")
+
+    with mock.patch("olx.offer.get_content_for_url", side_effect=get_content_for_url):
+        results = dict(olx.offer.parse_offers([OFFER_URL, failing_url], workers=2, processes=processes))
+    assert results[failing_url] is None
+    assert results[OFFER_URL] == olx.offer.parse_offer_markup(read_fixture("offer.html"), OFFER_URL)
+
+
+def test_iter_category_is_lazy():
+    with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+        get_content_for_url.return_value = fixture_response("category.html")
+        offers = olx.category.iter_category(url=GDANSK_URL, deduplicate=False)
+        assert get_content_for_url.call_count == 0
+        first = next(offers)
+        calls = get_content_for_url.call_count
+        rest = list(offers)
+    page_offers = olx.category.parse_available_offers(read_fixture("category.html"))
+    assert first == page_offers[0]
+    assert calls < get_content_for_url.call_count
+    assert [first] + rest == page_offers * 12
+
+
+def test_iter_category_parse():
+    with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+        with mock.patch("olx.offer.get_content_for_url") as get_offer_content:
+            get_content_for_url.return_value = fixture_response("category.html")
+            get_offer_content.return_value = fixture_response("offer.html")
+            offers = list(islice(olx.category.iter_category(url=GDANSK_URL, parse=True), 3))
+    assert len(offers) == 3
+    assert all(offer["add_id"] == "393658437" for offer in offers)
+
+
+def test_iter_category_loads_first_page_once():
+    stats = {}
+    with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+        get_content_for_url.return_value = fixture_response("category.html")
+        offers = olx.category.iter_category(url=GDANSK_URL, stats=stats)
+        next(offers)
+        assert stats == {"page_count": 12, "ads_count": 530, "duplicates": 2}
+        list(offers)
+    urls = [call[0][0] for call in get_content_for_url.call_args_list]
+    assert len(urls) == len(set(urls)) == 12
+
+
+@pytest.mark.parametrize("max_offers,max_pages,expected_offers,expected_pages", [
+    (3, None, 3, 1),
+    (15, None, 15, 2),
+    (None, 2, 20, 2),
+    (25, 2, 20, 2),
+])
+def test_get_category_limits(max_offers, max_pages, expected_offers, expected_pages):
+    with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+        get_content_for_url.return_value = fixture_response("category.html")
+        offers = olx.category.get_category(url=GDANSK_URL, max_offers=max_offers, max_pages=max_pages,
+                                           deduplicate=False)
+    assert len(offers) == expected_offers
+    assert get_content_for_url.call_count == expected_pages
+
+
+def test_get_offers_for_page_max_offers():
+    with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+        get_content_for_url.return_value = fixture_response("category.html")
+        assert len(olx.category.get_offers_for_page(2, url=GDANSK_URL, max_offers=4)) == 4
+
+
+def test_parse_search_page_ids():
+    result = olx.category.parse_search_page(read_fixture("category.html"))
+    assert len(result["ids"]) == len(result["offers"])
+    assert result["ids"][2] == "393658437"
+
+
+def test_get_category_seen_ids():
+    seen_ids = set()
+    with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+        get_content_for_url.return_value = fixture_response("category.html")
+        first_crawl = olx.category.get_category(url=GDANSK_URL, seen_ids=seen_ids)
+        assert get_content_for_url.call_count == 2
+        assert len(seen_ids) == 8
+        assert olx.category.get_category(url=GDANSK_URL, seen_ids=seen_ids) == []
+        assert get_content_for_url.call_count == 3
+    assert len(first_crawl) == 8
+
+
+def test_iter_category_since():
+    with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+        with mock.patch("olx.offer.get_content_for_url") as get_offer_content:
+            get_content_for_url.return_value = fixture_response("category.html")
+            get_offer_content.return_value = fixture_response("offer.html")
+            date_added = olx.offer.get_date_added(read_fixture("offer.html"))
+            offers = list(olx.category.iter_category(url=GDANSK_URL, parse=True, since=date_added + 1))
+    assert offers == []
+    assert get_content_for_url.call_count == 1
+
+
+def test_response_cache_memory_lru():
+    cache = olx.cache.ResponseCache(memory_size=3 * (olx.cache.ENTRY_OVERHEAD + 100))
+    for page in range(4):
+        url = GDANSK_URL + "?page={0}".format(page)
+        cache.set(url, make_response(url, b"x" * 100))
+    assert cache.get(GDANSK_URL + "?page=0") is None
+    response = cache.get(GDANSK_URL + "?page=3")
+    assert response.from_cache and response.content == b"x" * 100
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 1, 1)
+
+
+def test_response_cache_ttl():
+    cache = olx.cache.ResponseCache(listing_ttl=60, offer_ttl=3600)
+    cache.set(GDANSK_URL, make_response(GDANSK_URL))
+    cache.set(OFFER_URL, make_response(OFFER_URL))
+    with mock.patch("olx.cache.time.time", return_value=olx.cache.time.time() + 120):
+        assert cache.get(GDANSK_URL) is None
+        assert cache.get(OFFER_URL) is not None
+    assert cache.stats()["expired"] == 1
+
+
+def test_response_cache_disk(tmpdir):
+    disk = olx.cache.DiskStore(str(tmpdir), max_size=20000)
+    cache = olx.cache.ResponseCache(memory_size=0, disk=disk)
+    for page in range(4):
+        url = GDANSK_URL + "?page={0}".format(page)
+        cache.set(url, make_response(url, os.urandom(8000)))
+    assert len(tmpdir.listdir()) == 2
+    urls = [GDANSK_URL + "?page={0}".format(page) for page in range(4)]
+    shared_cache = olx.cache.ResponseCache(disk=olx.cache.DiskStore(str(tmpdir)))
+    assert len([url for url in urls if shared_cache.get(url) is not None]) == 2
+
+
+def test_get_content_for_url_cache():
+    session = mock.Mock()
+    session.get.return_value = make_response(GDANSK_URL, b"page")
+    with mock.patch("olx.utils.CACHE", olx.cache.ResponseCache()):
+        assert olx.utils.get_content_for_url(GDANSK_URL, session=session).content == b"page"
+        assert olx.utils.get_content_for_url(GDANSK_URL, session=session).content == b"page"
+    assert session.get.call_count == 1
+
+
+def test_get_content_for_url_revalidation():
+    session = mock.Mock()
+    session.get.return_value = make_response(OFFER_URL, read_fixture("offer.html"), {"ETag": '"v1"'})
+    cache = olx.cache.ResponseCache(offer_ttl=0)
+    with mock.patch("olx.utils.CACHE", cache):
+        with mock.patch("olx.offer.get_content_for_url",
+                        side_effect=lambda url: olx.utils.get_content_for_url(url, session=session)):
+            offer = olx.offer.parse_offer(OFFER_URL)
+            not_modified = make_response(OFFER_URL, b"")
+            not_modified.status_code = 304
+            session.get.return_value = not_modified
+            with mock.patch("olx.offer.parse_offer_markup") as parse_offer_markup:
+                assert olx.offer.parse_offer(OFFER_URL) == offer
+            assert not parse_offer_markup.called
+    assert session.get.call_args[1]["headers"]["If-None-Match"] == '"v1"'
+    assert cache.stats()["revalidated"] == 1
+
+
+@pytest.mark.parametrize("compression", ["zlib", "zstd", "none"])
+def test_segment_store(tmpdir, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    page = read_fixture("offer.html")
+    dictionary = None
+    if compression != "none":
+        dictionary = olx.cache.build_dictionary([page, read_fixture("category.html")] * 4)
+    store = olx.cache.SegmentStore(str(tmpdir), compression=compression, dictionary=dictionary, segment_size=4096)
+    for number in range(20):
+        store.set("key{0}".format(number), {"content": page, "number": number})
+    shared_store = olx.cache.SegmentStore(str(tmpdir))
+    assert shared_store.get("key19") == {"content": page, "number": 19}
+    store.delete("key0")
+    assert shared_store.get("key0") is None
+    assert len(shared_store) == 19
+    if compression != "none":
+        assert store.size < 20 * len(page) / 3
+
+
+@pytest.mark.parametrize("compression", ["zlib", "none"])
+def test_segment_store_corrupted_record(tmpdir, compression):
+    store = olx.cache.SegmentStore(str(tmpdir), compression=compression)
+    store.set("key", {"content": read_fixture("offer.html")})
+    with open(store._segment_path(1), "r+b") as segment:
+        segment.seek(olx.cache.RECORD_HEADER.size + len(b"key"))
+        segment.write(b"\x00" * 64)
+    shared_store = olx.cache.SegmentStore(str(tmpdir))
+    assert shared_store.get("key") is None
+    assert len(shared_store) == 0
+
+
+def test_segment_store_eviction(tmpdir):
+    store = olx.cache.SegmentStore(str(tmpdir), compression="none", segment_size=10000, max_size=30000)
+    for number in range(20):
+        store.set("key{0}".format(number), {"content": os.urandom(2000)})
+    assert store.size <= 30000 + 10000
+    assert store.get("key0") is None
+    assert store.get("key19") is not None
+    assert store.evictions
+
+
+def test_default_store_directories(tmpdir):
+    with mock.patch("olx.cache.CACHE_DIR", str(tmpdir)):
+        disk = olx.cache.DiskStore()
+        segments = olx.cache.SegmentStore(compression="zlib")
+    assert disk.directory != segments.directory
+    segments.set("key", {"content": b"page"})
+    disk.clear()
+    assert segments.get("key") == {"content": b"page"}
+
+
+def test_response_cache_segment_store(tmpdir):
+    cache = olx.cache.ResponseCache(memory_size=0, disk=olx.cache.SegmentStore(str(tmpdir)))
+    cache.set(OFFER_URL, make_response(OFFER_URL, read_fixture("offer.html")))
+    assert cache.get(OFFER_URL).content == read_fixture("offer.html")
+
+
+def test_response_cache_extracted(tmpdir):
+    store = olx.cache.SegmentStore(str(tmpdir))
+    cache = olx.cache.ResponseCache(disk=store)
+    cache.set(OFFER_URL, make_response(OFFER_URL, read_fixture("offer.html")))
+    with mock.patch.object(store, "set") as disk_set:
+        cache.set_extracted(OFFER_URL, {"add_id": "393658437"})
+    assert not disk_set.called
+    assert cache.get(OFFER_URL).extracted == {"add_id": "393658437"}
+    assert "extracted" not in store.get(olx.cache.cache_key(OFFER_URL))
+
+
+@pytest.mark.parametrize("value,expected", [("120", 120.0), (None, None), ("soon", None), ("-3", 0.0)])
+def test_parse_retry_after(value, expected):
+    assert olx.throttle.parse_retry_after(value) == expected
+
+
+def test_rate_limiter():
+    limiter = olx.throttle.RateLimiter(rate=100, burst=2)
+    start = olx.throttle.time.time()
+    for _ in range(6):
+        limiter.acquire()
+    assert olx.throttle.time.time() - start >= 0.03
+
+
+def test_adaptive_concurrency():
+    concurrency = olx.throttle.AdaptiveConcurrency(initial=4, minimum=1, maximum=8)
+    concurrency.on_success()
+    assert 4 < concurrency.limit < 5
+    for _ in range(100):
+        concurrency.on_success()
+    assert concurrency.limit == 8
+    for _ in range(4):
+        concurrency.on_throttle()
+    assert concurrency.limit == 1
+
+
+def test_host_throttle_retry_after():
+    throttle = olx.throttle.HostThrottle(rate=None, initial=4)
+    throttled = make_response(GDANSK_URL, headers={"Retry-After": "0.2"})
+    throttled.status_code = 429
+    assert throttle.record(throttled)
+    assert throttle.concurrency.limit == 2
+    start = olx.throttle.time.time()
+    with throttle:
+        pass
+    assert olx.throttle.time.time() - start >= 0.15
+
+
+def test_get_category_failed_page():
+    with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+        get_content_for_url.side_effect = [fixture_response("category.html"), None]
+        assert len(olx.category.get_category(url=GDANSK_URL, deduplicate=False)) == 10
+
+
+@pytest.mark.parametrize("error,status_code,expected", [
+    (olx.utils.requests.ConnectTimeout(), None, "connect"),
+    (olx.utils.requests.ReadTimeout(), None, "timeout"),
+    (olx.utils.requests.ConnectionError(), None, "connect"),
+    (None, 429, "throttled"),
+    (None, 502, "server"),
+    (None, 503, "throttled"),
+    (None, 404, None),
+])
+def test_get_error_class(error, status_code, expected):
+    response = None
+    if status_code:
+        response = make_response(GDANSK_URL)
+        response.status_code = status_code
+    assert olx.throttle.get_error_class(response, error) == expected
+
+
+def test_retry_policy():
+    policy = olx.throttle.RetryPolicy({"server": (2, 1.0)}, max_backoff=1.5)
+    assert 0 <= policy.delay("server", 0) <= 1.0
+    assert 0 <= policy.delay("server", 1) <= 1.5
+    assert policy.delay("server", 2) is None
+    assert policy.delay(None, 0) is None
+
+
+def test_get_content_for_url_retry():
+    url = "https://retry.example/"
+    session = mock.Mock()
+    session.get.side_effect = [olx.utils.requests.ConnectionError(), make_response(url)]
+    with mock.patch("olx.utils.RETRY_POLICY", olx.throttle.RetryPolicy({"connect": (1, 0.01)})):
+        assert olx.utils.get_content_for_url(url, session=session) is not None
+        session.get.side_effect = olx.utils.requests.ConnectionError()
+        assert olx.utils.get_content_for_url(url, session=session) is None
+    assert session.get.call_count == 4
+
+
+def test_circuit_breaker():
+    circuit = olx.throttle.CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    circuit.record_failure()
+    assert circuit.allow()
+    circuit.record_failure()
+    assert not circuit.allow()
+    olx.throttle.time.sleep(0.06)
+    assert circuit.allow() and circuit.state == "half-open"
+    assert not circuit.allow()
+    circuit.record_failure()
+    assert circuit.state == "open"
+    olx.throttle.time.sleep(0.06)
+    assert circuit.allow()
+    circuit.record_success()
+    assert circuit.state == "closed" and circuit.failures == 0
+
+
+@pytest.mark.parametrize("trial_succeeds", [True, False])
+def test_circuit_breaker_wait(trial_succeeds):
+    circuit = olx.throttle.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    circuit.record_failure()
+    assert circuit.wait() and circuit.state == "half-open"
+    results = []
+    waiting = olx.throttle.threading.Thread(target=lambda: results.append(circuit.wait()))
+    waiting.start()
+    olx.throttle.time.sleep(0.02)
+    if trial_succeeds:
+        circuit.record_success()
+    else:
+        circuit.record_failure()
+    waiting.join()
+    assert results == [trial_succeeds]
+
+
+def test_get_content_for_url_circuit_open():
+    url = "https://failing.example/"
+    session = mock.Mock()
+    session.get.side_effect = olx.utils.requests.ConnectionError()
+    olx.utils.set_circuit_breaking(failure_threshold=1, reset_timeout=0.05)
+    try:
+        with mock.patch("olx.utils.RETRY_POLICY", None):
+            assert olx.utils.get_content_for_url(url, session=session) is None
+            start = olx.throttle.time.time()
+            # Waits for trial request, which fails again
+            assert olx.utils.get_content_for_url(url, session=session) is None
+            assert olx.throttle.time.time() - start >= 0.04
+        assert session.get.call_count == 2
+    finally:
+        olx.utils.set_circuit_breaking()
+
+
+def test_get_offer_id():
+    assert olx.utils.get_offer_id(OFFER_URL) == "nT89A"
+    assert olx.utils.get_offer_id(GDANSK_URL) is None
+
+
+def test_iter_category_deduplicate():
+    stats = {}
+    with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+        with mock.patch("olx.offer.get_content_for_url") as get_offer_content:
+            get_content_for_url.return_value = fixture_response("category.html")
+            get_offer_content.return_value = fixture_response("offer.html")
+            offers = list(olx.category.iter_category(url=GDANSK_URL, parse=True, max_pages=3, stats=stats))
+    assert len(offers) == 8
+    assert get_offer_content.call_count == 8
+    assert stats["duplicates"] == 22
+
+
+@pytest.mark.parametrize("url,expected", [
+    (OFFER_URL, "https://www.olx.pl/oferta/gdansk-przymorze-dla-studentow-CID3-IDnT89A.html"),
+    (GDANSK_URL + "?", GDANSK_URL),
+    (GDANSK_URL + "?page=2&utm_source=mail&search%5Bprivate_business%5D=private&",
+     GDANSK_URL + "?page=2&search%5Bprivate_business%5D=private"),
+    ("https://www.olx.pl/nieruchomosci/Ruda%20%C5%9Al%C4%85ska/?search[filter_float_m:to]=50",
+     "https://www.olx.pl/nieruchomosci/ruda-slaska/?search%5Bfilter_float_m%3Ato%5D=50"),
+    ("https://www.olx.pl/oferty/q-iPhone-X/", "https://www.olx.pl/oferty/q-iPhone-X/"),
+    ("https://www.olx.pl/Gdańsk/q-łódka/", "https://www.olx.pl/gdansk/q-%C5%82%C3%B3dka/"),
+    (GDANSK_URL + "?q=dwa+pokoje", GDANSK_URL + "?q=dwa+pokoje"),
+    (GDANSK_URL + "?q=dwa%20pokoje", GDANSK_URL + "?q=dwa+pokoje"),
+    (GDANSK_URL + "?q=c%2B%2B", GDANSK_URL + "?q=c%2B%2B"),
+])
+def test_canonical_url(url, expected):
+    assert olx.utils.canonical_url(url) == expected
+
+
+def test_get_url_search_query():
+    assert olx.utils.get_url("nieruchomosci", search_query="łódka") == \
+        "https://www.olx.pl/nieruchomosci/q-%C5%82%C3%B3dka/"
+
+
+def test_get_url_filters_order():
+    filters = {"[filter_float_price:from]": 2000, "[filter_float_m:to]": 50}
+    reversed_filters = dict(reversed(list(filters.items())))
+    assert olx.utils.get_url(region="gdansk", page=2, **filters) == \
+        olx.utils.get_url(region="gdansk", page=2, **reversed_filters)
+
+
+def test_get_content_for_url_canonical_cache():
+    session = mock.Mock()
+    session.get.return_value = make_response(OFFER_URL, b"offer")
+    with mock.patch("olx.utils.CACHE", olx.cache.ResponseCache()):
+        olx.utils.get_content_for_url(OFFER_URL, session=session)
+        olx.utils.get_content_for_url(OFFER_URL.replace("#1d9db51b24", "#00000000pr"), session=session)
+    assert session.get.call_count == 1
+
+
+def test_parse_offer_cached_copy():
+    session = mock.Mock()
+    session.get.return_value = make_response(OFFER_URL, read_fixture("offer.html"))
+    with mock.patch("olx.utils.CACHE", olx.cache.ResponseCache()), mock.patch("olx.utils.get_session",
+                                                                              return_value=session):
+        offer = olx.offer.parse_offer(OFFER_URL)
+        offer["title"] = "changed"
+        assert olx.offer.parse_offer(OFFER_URL)["title"] == "Gdańsk Przymorze dla studentów"
+    assert session.get.call_count == 1
+
+
+def test_parse_offer_markup_record():
+    offer = olx.offer.parse_offer_markup(read_fixture("offer.html"), OFFER_URL)
+    record = olx.offer.parse_offer_markup(read_fixture("offer.html"), OFFER_URL, record=True)
+    assert isinstance(record.latitude, float) and record.gps == tuple(float(value) for value in offer["gps"])
+    assert record["add_id"] == record.add_id == offer["add_id"]
+    assert record.to_dict() == dict(offer, gps=record.gps)
+    assert not hasattr(record, "__dict__")
+    other = olx.offer.Offer(**dict(offer, city="".join(list(offer["city"]))))
+    assert other.city is record.city
+
+
+def test_offer_record_pickle():
+    record = olx.offer.parse_offer_markup(read_fixture("offer.html"), OFFER_URL, record=True)
+    assert olx.cache.pickle.loads(olx.cache.pickle.dumps(record)) == record
+
+
+def test_parse_offers_record():
+    with mock.patch("olx.offer.get_content_for_url") as get_content_for_url:
+        get_content_for_url.return_value = fixture_response("offer.html")
+        results = list(olx.offer.parse_offers([OFFER_URL], record=True))
+    assert isinstance(results[0][1], olx.offer.Offer)
+
+
+def parsed_offers(count):
+    offer = olx.offer.parse_offer_markup(read_fixture("offer.html"), OFFER_URL)
+    return [dict(offer, add_id=str(index)) for index in range(count)] + [olx.offer.Offer(**offer)]
+
+
+def test_offer_columns():
+    columns = olx.export.offer_columns(parsed_offers(2))
+    assert columns["add_id"][:2] == ["0", "1"]
+    assert all(isinstance(value, float) for value in columns["latitude"])
+    assert columns["surface"] == [38.0] * 3
+
+
+@pytest.mark.parametrize("export_format", ["csv", "parquet", "arrow"])
+def test_export(tmpdir, export_format):
+    if export_format != "csv":
+        pytest.importorskip("pyarrow")
+    path = str(tmpdir.join("offers." + export_format))
+    assert olx.export.export(iter(parsed_offers(5)), path, row_group_size=2) == 6
+    if export_format == "csv":
+        with open(path, encoding="utf-8") as csv_file:
+            rows = list(olx.export.csv.DictReader(csv_file))
+        assert len(rows) == 6 and rows[0]["rooms"] == "2"
+    elif export_format == "parquet":
+        parquet_file = olx.export.pyarrow.parquet.ParquetFile(path)
+        assert parquet_file.metadata.num_row_groups == 3
+        assert parquet_file.schema_arrow.names == list(olx.export.COLUMNS)
+        assert parquet_file.schema_arrow.field("latitude").type == olx.export.pyarrow.float64()
+    else:
+        table = olx.export.pyarrow.ipc.open_file(path).read_all()
+        assert table.num_rows == 6 and table.column("price").type == olx.export.pyarrow.int64()
+
+
+def test_batch_writer_is_abstract(tmpdir):
+    with pytest.raises(TypeError):
+        olx.export.BatchWriter(str(tmpdir.join("offers")))
+
+
+def test_to_dataframe():
+    pytest.importorskip("pandas")
+    dataframe = olx.export.to_dataframe(parsed_offers(2))
+    assert list(dataframe.columns) == list(olx.export.COLUMNS)
+    assert str(dataframe["rooms"].dtype) == "Int64"
+    assert str(dataframe["date_added"].dtype).startswith("datetime64")
+
+
+def test_offer_store(tmpdir):
+    path = str(tmpdir.join("offers.db"))
+    with olx.storage.OfferStore(path, batch_size=2) as store:
+        assert store.write_all(parsed_offers(3)) == 4
+        assert "1" in store and "missing" not in store
+        store.add_offer(dict(parsed_offers(1)[0], price=100))
+        assert "0" in store
+        assert store.get("0")["price"] == 100
+        assert store.get("1")["images"] == parsed_offers(1)[0]["images"]
+        journal_mode = store._connection.execute("PRAGMA journal_mode").fetchone()[0]
+    assert journal_mode == "wal"
+    with olx.storage.OfferStore(path) as store:
+        assert len(store) == 4
+        assert store.known_ids() == {"0", "1", "2", "393658437"}
+
+
+def test_offer_store_seen_ids(tmpdir):
+    with olx.storage.OfferStore(str(tmpdir.join("offers.db"))) as store:
+        with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+            with mock.patch("olx.offer.get_content_for_url") as get_offer_content:
+                get_content_for_url.return_value = fixture_response("category.html")
+                get_offer_content.return_value = fixture_response("offer.html")
+                store.write_all(olx.category.iter_category(url=GDANSK_URL, parse=True, seen_ids=store.known_ids()))
+                calls = get_offer_content.call_count
+                list(olx.category.iter_category(url=GDANSK_URL, parse=True, seen_ids=store))
+        assert len(store) == 1
+    assert get_offer_content.call_count == calls + 7
+
+
+def test_offer_store_as_seen_ids(tmpdir):
+    with olx.storage.OfferStore(str(tmpdir.join("offers.db"))) as store:
+        store.add_offer(parsed_offers(0)[0])
+        with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+            get_content_for_url.return_value = fixture_response("category.html")
+            urls = list(olx.category.iter_category(url=GDANSK_URL, seen_ids=store))
+            assert urls and list(olx.category.iter_category(url=GDANSK_URL, seen_ids=store)) == []
+        assert "393658437" in store and len(store) == 1
+
+
+def test_find_script_data():
+    assert olx.utils.find_script_data(read_fixture("category.html"), "page_count") == 12
+    assert olx.utils.find_script_data(read_fixture("category.html").decode("utf-8"), "GPT.targeting")["ads_count"] == \
+        "530"
+    assert olx.utils.find_script_data(read_fixture("offer.html"), "pageView")["ad_id"] == "393658437"
+    assert olx.utils.find_script_data(BeautifulSoup(read_fixture("offer.html"), "html.parser"), "pageView") is None
+    assert olx.utils.find_script_data(b"<script>GPT.targeting = {invalid};</script>", "GPT.targeting") is None
+
+
+def test_script_data_fast_path():
+    markup = read_fixture("offer.html")
+    with mock.patch("olx.offer.get_html_parser") as get_html_parser:
+        assert olx.offer.parse_tracking_data(markup) == (1800, "PLN", "393658437")
+        assert olx.offer.get_gpt_script(markup)["rooms"] == ["two"]
+        assert not get_html_parser.called
+    with mock.patch("olx.category.get_html_parser") as get_html_parser:
+        assert olx.category.get_page_count(read_fixture("category.html")) == 12
+        assert olx.category.parse_ads_count(read_fixture("category.html")) == 530
+        assert not get_html_parser.called
+
+
+def test_script_data_fallback():
+    html_parser = BeautifulSoup(read_fixture("category.html"), "html.parser")
+    assert olx.category.get_page_count(html_parser) == 12
+    assert olx.category.parse_ads_count(html_parser) == 530
+    offer_parser = BeautifulSoup(read_fixture("offer.html"), "html.parser")
+    assert olx.offer.parse_offer_markup(offer_parser, OFFER_URL) == \
+        olx.offer.parse_offer_markup(read_fixture("offer.html"), OFFER_URL)
+
+
+def streamed_response(url, content):
+    response = make_response(url)
+    response._content = False
+    response.raw = io.BytesIO(content)
+    return response
+
+
+def test_get_content_for_url_markers():
+    content = read_fixture("category.html")
+    session = mock.Mock()
+    session.get.side_effect = lambda url, **kwargs: streamed_response(url, content)
+    with mock.patch("olx.utils.CHUNK_SIZE", 256), mock.patch("olx.utils.CACHE", olx.cache.ResponseCache()) as cache:
+        response = olx.utils.get_content_for_url(GDANSK_URL, session=session, markers=("page_count", "GPT.targeting"))
+        assert session.get.call_args[1]["stream"]
+        assert response.partial and len(response.content) < len(content)
+        assert olx.category.get_page_count(response.content) == 12
+        assert olx.category.parse_ads_count(response.content) == 530
+        assert cache.lookup(GDANSK_URL)[0] is None
+        response = olx.utils.get_content_for_url(GDANSK_URL, session=session, markers=("pageView",))
+        assert not response.partial and response.content == content
+
+
+def test_get_page_count_for_filters_partial():
+    with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+        get_content_for_url.return_value = fixture_response("category.html")
+        assert olx.category.get_page_count_for_filters(url=GDANSK_URL) == 12
+        assert olx.category.get_ads_count_for_filters(url=GDANSK_URL) == 530
+    assert get_content_for_url.call_args_list[0][1]["markers"] == ("page_count",)
+
+
+def test_stand_in_pages():
+    listing = loadtest.render_listing("http://127.0.0.1:8000", 1, pages=3, offers_per_page=5, promoted=2)
+    search_page = olx.category.parse_search_page(listing)
+    assert search_page["page_count"] == 3 and search_page["ads_count"] == 17
+    assert len(search_page["offers"]) == 7
+    assert olx.utils.get_offer_id(search_page["offers"][2]) == "L5"
+    offer = olx.offer.parse_offer_markup(loadtest.render_offer(5), search_page["offers"][2])
+    assert offer["add_id"] == str(loadtest.FIRST_AD_ID + 5) and offer["title"] == "Oferta 5"
+
+
+def test_stand_in_server_faults():
+    server = loadtest.StandInServer(throttle_rate=0.5, error_rate=0.5, seed=1)
+    status_codes = {server.respond("/oferta/oferta-1-CID3-IDL1.html")[0] for _ in range(20)}
+    assert status_codes == {429, 500}
+    assert server.counters["throttled"] + server.counters["errors"] == 20
+
+
+def test_run_load_test_restores_settings():
+    session = olx.utils.get_session()
+    olx.utils.set_throttling(False)
+    olx.utils.set_circuit_breaking(failure_threshold=3)
+    server = mock.Mock(counters={"listing": 0, "offer": 0, "errors": 0, "throttled": 0})
+    try:
+        with mock.patch("loadtest.get_category", return_value=[]), mock.patch("loadtest.parse_offers", return_value=[]):
+            assert loadtest.run_load_test(server, workers=2, rate=5)["offers"] == 0
+        assert olx.utils.get_session() is session
+        assert not olx.utils.THROTTLING
+        assert olx.utils._circuit_settings == {"failure_threshold": 3}
+    finally:
+        olx.utils.set_throttling()
+        olx.utils.set_circuit_breaking()
+
+
+@pytest.fixture
+def collected_metrics():
+    olx.metrics.reset()
+    yield olx.metrics.COLLECTOR
+    olx.metrics.reset()
+
+
+def test_metrics_prometheus(collected_metrics):
+    olx.metrics.increment("olx_pages_total", 2)
+    olx.metrics.observe("olx_fetch_seconds", 0.02)
+    olx.metrics.observe("olx_fetch_seconds", 20)
+    text = olx.metrics.to_prometheus()
+    assert "# TYPE olx_pages_total counter\nolx_pages_total 2\n" in text
+    assert 'olx_fetch_seconds_bucket{le="0.025"} 1\n' in text
+    assert 'olx_fetch_seconds_bucket{le="+Inf"} 2\n' in text
+    assert "olx_fetch_seconds_count 2\n" in text
+
+
+def test_metrics_hooks(collected_metrics):
+    recorded = []
+    hook = lambda *args: recorded.append(args)
+    olx.metrics.add_hook(hook)
+    try:
+        with olx.metrics.timer("olx_parse_seconds", page="offer"):
+            pass
+    finally:
+        olx.metrics.remove_hook(hook)
+    assert recorded[0][:2] == ("olx_parse_seconds", "histogram") and recorded[0][3] == {"page": "offer"}
+    statsd = olx.metrics.StatsdHook(prefix="crawler")
+    assert statsd.format("olx_parse_seconds", "histogram", 0.0125, {"page": "offer"}) == \
+        "crawler.olx_parse_seconds.offer:12.500|ms"
+    assert statsd.format("olx_pages_total", "counter", 1, {}) == "crawler.olx_pages_total:1|c"
+
+
+def test_metrics_fetch_and_parse(collected_metrics):
+    session = mock.Mock()
+    session.get.return_value = make_response(OFFER_URL, read_fixture("offer.html"))
+    with mock.patch("olx.utils.CACHE", olx.cache.ResponseCache()):
+        olx.utils.get_content_for_url(OFFER_URL, session=session)
+        olx.utils.get_content_for_url(OFFER_URL, session=session)
+    olx.offer.parse_offer_markup(read_fixture("offer.html"), OFFER_URL)
+    counters = collected_metrics.counters
+    assert counters[("olx_cache_requests_total", (("result", "hit"),))] == 1
+    assert counters[("olx_cache_requests_total", (("result", "miss"),))] == 1
+    assert counters[("olx_downloaded_bytes_total", ())] == len(read_fixture("offer.html"))
+    assert collected_metrics.histograms[("olx_fetch_seconds", ())]["count"] == 1
+    assert collected_metrics.histograms[("olx_extract_seconds", (("extractor", "get_title"),))]["count"] == 1
+
+
+def test_iter_category_rates():
+    stats = {}
+    with mock.patch("olx.category.get_content_for_url") as get_content_for_url:
+        get_content_for_url.return_value = fixture_response("category.html")
+        list(olx.category.iter_category(url=GDANSK_URL, max_pages=2, stats=stats))
+    assert stats["pages"] == 2 and stats["offers"] == 8
+    assert stats["offers_per_second"] > 0
+
+
+def test_circuit_breaker_throttled_trial():
+    url = "https://half-open.example/"
+    throttled = make_response(url)
+    throttled.status_code = 429
+    session = mock.Mock()
+    session.get.side_effect = [olx.utils.requests.ConnectionError(), throttled, make_response(url),
+                               make_response(url)]
+    olx.utils.set_circuit_breaking(failure_threshold=1, reset_timeout=0.05)
+    olx.utils.set_throttling(False)
+    try:
+        with mock.patch("olx.utils.RETRY_POLICY", None):
+            assert olx.utils.get_content_for_url(url, session=session) is None
+            olx.throttle.time.sleep(0.06)
+            assert olx.utils.get_content_for_url(url, session=session) is None
+            assert olx.utils.get_circuit_breaker(url).state == "open"
+            olx.throttle.time.sleep(0.06)
+            assert olx.utils.get_content_for_url(url, session=session) is not None
+            assert olx.utils.get_content_for_url(url, session=session) is not None
+        assert olx.utils.get_circuit_breaker(url).state == "closed"
+    finally:
+        olx.utils.set_circuit_breaking()
+        olx.utils.set_throttling()
+
+
+def test_circuit_breaker_unexpected_error():
+    circuit = olx.throttle.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    circuit.record_failure()
+    session = mock.Mock()
+    session.get.side_effect = ValueError()
+    with mock.patch("olx.utils.get_circuit_breaker", return_value=circuit):
+        with pytest.raises(ValueError):
+            olx.utils.get_content_for_url("https://unexpected.example/", session=session)
+    assert circuit.state == "open"